@@ -1,20 +1,60 @@
 
 import os
-import yaml
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Local config files, in order of preference. env.json needs only the stdlib;
+# env.yaml is still read for existing setups, but requires PyYAML to be installed.
+ENV_FILES = ('env.json', 'env.yaml')
+
+# Parsed env file contents keyed by (path, mtime_ns, size)
+_ENV_CACHE = {}
+
+def _parse_env_file(env_path, raw):
+    if env_path.endswith(('.yaml', '.yml')):
+        try:
+            import yaml # Optional: only needed for legacy env.yaml files
+        except ImportError as e:
+            raise ImportError(f"{env_path} requires PyYAML: install PyYAML or convert it to env.json") from e
+        # libyaml-backed loader is much faster than the pure-Python SafeLoader
+        return yaml.load(raw, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader)) or {}
+    return json_loads(raw) or {}
+
+def _read_first_env_file(candidates):
+    """Returns (path, parsed dict) for the first existing file in candidates, or (None, None)."""
+    for env_path in candidates:
+        try:
+            st = os.stat(env_path)
+        except OSError:
+            continue
+        cache_key = (env_path, st.st_mtime_ns, st.st_size)
+        env_vars = _ENV_CACHE.get(cache_key)
+        if env_vars is None:
+            with open(env_path, 'rb') as f:
+                env_vars = _parse_env_file(env_path, f.read())
+            _ENV_CACHE[cache_key] = env_vars
+        return env_path, env_vars
+    return None, None
+
+def read_env_file(env_path=None):
+    """
+    Returns the parsed contents of env_path (default: the first of ENV_FILES found)
+    as a dict, or None if the file does not exist.
+    Parsing is cached until the file's mtime or size changes.
+    """
+    return _read_first_env_file((env_path,) if env_path else ENV_FILES)[1]
 
 def load_env():
     """
-    Loads environment variables from env.yaml if it exists.
+    Loads environment variables from env.json (or env.yaml) if it exists.
     This is for local development. In a deployed environment,
     variables should be set directly.
     """
-    env_path = 'env.yaml'
-    if os.path.exists(env_path):
-        print("--- Loading environment variables from env.yaml for local development ---")
-        with open(env_path, 'r') as f:
-            env_vars = yaml.safe_load(f)
-        if env_vars:
-            for key, value in env_vars.items():
-                if key not in os.environ:
-                    os.environ[key] = str(value)
-    
+    env_path, env_vars = _read_first_env_file(ENV_FILES)
+    if env_vars is None:
+        return
+    print(f"--- Loading environment variables from {env_path} for local development ---")
+    for key, value in env_vars.items():
+        os.environ.setdefault(key, str(value))
@@ -1,11 +1,25 @@
 import os
-import base64
+try:
+    import pybase64 as base64 # SIMD-accelerated drop-in for the stdlib module
+except ImportError:
+    import base64
 import json
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps_bytes = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+    def _json_dumps_bytes(obj):
+        return json.dumps(obj).encode("UTF-8")
+import datetime
+import threading
+import time
+import weakref
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from email.message import EmailMessage
+from email.generator import BytesGenerator
 from io import BytesIO
 
 # Scopes required for the bot
@@ -15,11 +29,48 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify' # To remove UNREAD label
 ]
 
+# Gmail accepts at most 100 calls per batch request
+BATCH_SIZE = 100
+
 # Secret Manager Configuration
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "super-home-automation")
 SECRET_ID = os.environ.get("GCP_SECRET_ID", "gmail-oauth-token")
 SECRET_VERSIONS_TO_KEEP_ENV = "GCP_SECRET_VERSIONS_TO_KEEP"
 
+# Reused across warm invocations so the gRPC channel is only set up once
+_SM_CLIENT = None
+
+# Secret Manager backed Gmail service, reused across warm invocations
+# until its access token gets within TOKEN_EXPIRY_MARGIN of expiring
+_GMAIL_SERVICE = None
+_GMAIL_SERVICE_EXPIRY = None
+TOKEN_EXPIRY_MARGIN = datetime.timedelta(minutes=5)
+
+# Token last read from (or written to) Secret Manager. Served without another
+# Secret Manager call for TOKEN_CACHE_TTL seconds, under the 1h access token lifetime.
+_TOKEN_CACHE = {"info": None, "fetched_at": 0.0}
+TOKEN_CACHE_TTL = 55 * 60
+
+# Shared token-refresh transport: keeps the HTTPS connection to the OAuth endpoint alive
+_AUTH_REQUEST = Request()
+
+# Bundled Gmail discovery document text, see _build_gmail
+_GMAIL_DISCOVERY_DOC = None
+
+# Per-thread (base service, thread service) pair, see get_thread_gmail_service
+_THREAD_LOCAL = threading.local()
+
+# Credentials of each service returned by get_gmail_service, for get_thread_gmail_service
+_SERVICE_CREDENTIALS = weakref.WeakKeyDictionary()
+
+def _get_secret_client():
+    """Return the process-wide Secret Manager client, creating it on first use."""
+    global _SM_CLIENT
+    if _SM_CLIENT is None:
+        from google.cloud import secretmanager
+        _SM_CLIENT = secretmanager.SecretManagerServiceClient()
+    return _SM_CLIENT
+
 def _get_secret_versions_to_keep():
     """Return how many secret versions to retain."""
     raw_value = os.environ.get(SECRET_VERSIONS_TO_KEEP_ENV, "3")
@@ -66,14 +117,17 @@ def prune_old_secret_versions(client, parent, keep_latest):
 
 def load_token_from_secret():
     """Load the Gmail token from Google Cloud Secret Manager."""
+    if _TOKEN_CACHE["info"] and time.monotonic() - _TOKEN_CACHE["fetched_at"] < TOKEN_CACHE_TTL:
+        return _TOKEN_CACHE["info"]
     try:
-        from google.cloud import secretmanager
-        client = secretmanager.SecretManagerServiceClient()
+        client = _get_secret_client()
         name = f"projects/{PROJECT_ID}/secrets/{SECRET_ID}/versions/latest"
         response = client.access_secret_version(request={"name": name})
         token_json = response.payload.data.decode("UTF-8")
-        print(f"Loaded token from Secret Manager (expiry: {json.loads(token_json).get('expiry', 'unknown')})")
-        return json.loads(token_json)
+        token_info = _json_loads(token_json)
+        print(f"Loaded token from Secret Manager (expiry: {token_info.get('expiry', 'unknown')})")
+        _TOKEN_CACHE.update(info=token_info, fetched_at=time.monotonic())
+        return token_info
     except json.JSONDecodeError as e:
         print(f"Error decoding token from Secret Manager: {e}")
         # Log a snippet relative safely
@@ -87,10 +141,9 @@ def load_token_from_secret():
 def save_token_to_secret(token_info):
     """Save the Gmail token to Google Cloud Secret Manager as a new version."""
     try:
-        from google.cloud import secretmanager
-        client = secretmanager.SecretManagerServiceClient()
+        client = _get_secret_client()
         parent = f"projects/{PROJECT_ID}/secrets/{SECRET_ID}"
-        payload = json.dumps(token_info).encode("UTF-8")
+        payload = _json_dumps_bytes(token_info)
         response = client.add_secret_version(
             request={"parent": parent, "payload": {"data": payload}}
         )
@@ -106,12 +159,34 @@ def save_token_to_secret(token_info):
         print(f"Error saving token to Secret Manager: {e}")
         return False
 
+def _build_gmail(creds):
+    """
+    Builds a Gmail service from the discovery document bundled with googleapiclient,
+    so no discovery HTTP round-trip (or discovery file cache) is involved.
+    The document text is read once per process. Each build parses its own copy,
+    since build_from_document mutates the parsed document as methods are created.
+    """
+    global _GMAIL_DISCOVERY_DOC
+    from googleapiclient.discovery import build_from_document
+    if _GMAIL_DISCOVERY_DOC is None:
+        from googleapiclient import discovery_cache
+        _GMAIL_DISCOVERY_DOC = discovery_cache.get_static_doc('gmail', 'v1')
+    return build_from_document(_json_loads(_GMAIL_DISCOVERY_DOC), credentials=creds)
+
 def get_gmail_service(token_json_path=None, token_info=None, use_secret_manager=False):
     """
     Returns an authenticated Gmail service object.
     Can use a local token.json file, a dictionary of token info, or Secret Manager.
     If token is refreshed and use_secret_manager is True, persists the new token.
+    With use_secret_manager, the built service is cached for later calls while its token is fresh.
     """
+    global _GMAIL_SERVICE, _GMAIL_SERVICE_EXPIRY
+    if use_secret_manager and _GMAIL_SERVICE is not None and _GMAIL_SERVICE_EXPIRY is not None:
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        if _GMAIL_SERVICE_EXPIRY - now > TOKEN_EXPIRY_MARGIN:
+            return _GMAIL_SERVICE
+
     creds = None
     
     # Try Secret Manager first if enabled
@@ -122,13 +197,16 @@ def get_gmail_service(token_json_path=None, token_info=None, use_secret_manager=
     
     if token_info:
         creds = Credentials.from_authorized_user_info(token_info, SCOPES)
-    elif token_json_path and os.path.exists(token_json_path):
-        creds = Credentials.from_authorized_user_file(token_json_path, SCOPES)
+    elif token_json_path:
+        try:
+            creds = Credentials.from_authorized_user_file(token_json_path, SCOPES)
+        except FileNotFoundError:
+            pass
         
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             print("Token expired, refreshing...")
-            creds.refresh(Request())
+            creds.refresh(_AUTH_REQUEST)
             print(f"Token refreshed. New expiry: {creds.expiry}")
             
             # Persist refreshed token to Secret Manager
@@ -143,28 +221,110 @@ def get_gmail_service(token_json_path=None, token_info=None, use_secret_manager=
                     "expiry": creds.expiry.isoformat() + "Z" if creds.expiry else None,
                 }
                 save_token_to_secret(new_token_info)
+                _TOKEN_CACHE.update(info=new_token_info, fetched_at=time.monotonic())
         else:
             raise Exception("No valid credentials found. Run setup_oauth.py locally first.")
 
-    return build('gmail', 'v1', credentials=creds)
+    service = _build_gmail(creds)
+    _SERVICE_CREDENTIALS[service] = creds
+    if use_secret_manager:
+        _GMAIL_SERVICE, _GMAIL_SERVICE_EXPIRY = service, creds.expiry
+    return service
 
+def get_thread_gmail_service(service):
+    """
+    Returns a Gmail service for the calling thread that shares the credentials of
+    `service`, which must come from get_gmail_service.
+    A service's httplib2 connection must not be used from several threads, while the
+    credentials can be, so each worker thread builds its own service once.
+    """
+    cached = getattr(_THREAD_LOCAL, 'service_pair', None)
+    if cached and cached[0] is service:
+        return cached[1]
+    thread_service = _build_gmail(_SERVICE_CREDENTIALS[service])
+    _THREAD_LOCAL.service_pair = (service, thread_service)
+    return thread_service
+
+def execute_batch(service, requests):
+    """
+    Executes a {request_id: HttpRequest} mapping through the Gmail batch endpoint,
+    BATCH_SIZE requests per HTTP call.
+    Returns {request_id: response}; failed requests map to their exception instead.
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response
+
+    items = list(requests.items())
+    for i in range(0, len(items), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for request_id, request in items[i:i + BATCH_SIZE]:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+    return results
 
 def get_message_content(service, user_id, msg_id):
     """Retrieves the full message content."""
     return service.users().messages().get(userId=user_id, id=msg_id, format='full').execute()
 
+def get_messages_metadata(service, user_id, msg_ids, headers=('Subject', 'From')):
+    """
+    Retrieves only the requested headers (plus mimeType) of several messages in batched
+    requests, keyed by message id. Much lighter than format='full' for triage.
+    """
+    messages = service.users().messages()
+    return execute_batch(service, {
+        msg_id: messages.get(userId=user_id, id=msg_id, format='metadata', metadataHeaders=list(headers))
+        for msg_id in msg_ids
+    })
+
+def get_messages_content(service, user_id, msg_ids):
+    """Retrieves the full content of several messages in batched requests, keyed by message id."""
+    messages = service.users().messages()
+    return execute_batch(service, {
+        msg_id: messages.get(userId=user_id, id=msg_id, format='full')
+        for msg_id in msg_ids
+    })
+
+def _decode_attachment(attachment):
+    """
+    Decodes an attachments.get response body. The base64 text is popped from the
+    response first so it can be freed as soon as decoding finishes. Returns bytes,
+    which BytesIO wraps without copying.
+    """
+    return base64.urlsafe_b64decode(attachment.pop('data'))
+
 def get_attachment_data(service, user_id, msg_id, attachment_id):
     """Retrieves attachment data."""
     attachment = service.users().messages().attachments().get(
         userId=user_id, messageId=msg_id, id=attachment_id
     ).execute()
-    data = base64.urlsafe_b64decode(attachment['data'])
-    return data
+    return _decode_attachment(attachment)
+
+def get_attachments_data(service, user_id, attachment_ids):
+    """
+    Retrieves several attachments in batched requests.
+    `attachment_ids` maps message id -> attachment id; returns message id -> decoded bytes
+    (or the exception raised for that attachment).
+    """
+    attachments = service.users().messages().attachments()
+    results = execute_batch(service, {
+        msg_id: attachments.get(userId=user_id, messageId=msg_id, id=attachment_id)
+        for msg_id, attachment_id in attachment_ids.items()
+    })
+    return {
+        msg_id: result if isinstance(result, Exception) else _decode_attachment(result)
+        for msg_id, result in results.items()
+    }
 
 def create_message_with_multiple_attachments(sender, to, subject, body, attachments):
     """
-    Creates an EmailMessage object with multiple attachments and encodes it for Gmail API.
+    Creates an EmailMessage object with multiple attachments and serializes it (RFC 822) into a BytesIO.
     `attachments` should be a list of dicts, e.g., [{'filename': 'file1.pdf', 'data': b'...'}]
+    'data' may also be a BytesIO; its contents are read only when the attachment is added.
+    The result is uploaded as-is by send_message, so attachments are base64-encoded only once
+    (inside the MIME body) instead of again for the API's 'raw' field.
     """
     message = EmailMessage()
     message.set_content(body)
@@ -172,25 +332,29 @@ def create_message_with_multiple_attachments(sender, to, subject, body, attachme
     message['From'] = sender
     message['Subject'] = subject
 
-    if attachments:
-        for attachment in attachments:
-            attachment_bytes = attachment.get('data')
-            filename = attachment.get('filename')
-            if attachment_bytes and filename:
-                message.add_attachment(
-                    attachment_bytes,
-                    maintype='application',
-                    subtype='pdf', # Assuming all attachments are PDFs
-                    filename=filename
-                )
-
-    # Encode the message
-    encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    return {'raw': encoded_message}
+    for attachment in attachments:
+        attachment_bytes = attachment.get('data')
+        filename = attachment.get('filename')
+        if isinstance(attachment_bytes, BytesIO):
+            attachment_bytes = attachment_bytes.getvalue()
+        if attachment_bytes and filename:
+            message.add_attachment(
+                attachment_bytes,
+                maintype='application',
+                subtype='pdf', # Assuming all attachments are PDFs
+                filename=filename
+            )
+
+    # Flatten straight into the buffer that send_message uploads, rather than
+    # building an intermediate bytes object with as_bytes()
+    buffer = BytesIO()
+    BytesGenerator(buffer, mangle_from_=False, policy=message.policy).flatten(message)
+    buffer.seek(0)
+    return buffer
 
 def create_message_with_attachment(sender, to, subject, body, attachment_bytes, filename):
     """
-    Creates an EmailMessage object and encodes it for Gmail API.
+    Creates an EmailMessage object and serializes it for send_message.
     This is now a wrapper around create_message_with_multiple_attachments.
     """
     attachments = []
@@ -200,9 +364,11 @@ def create_message_with_attachment(sender, to, subject, body, attachment_bytes,
     return create_message_with_multiple_attachments(sender, to, subject, body, attachments)
 
 def send_message(service, user_id, message):
-    """Sends the message."""
+    """Sends a serialized message (as built by create_message_*) through the Gmail media upload endpoint."""
+    from googleapiclient.http import MediaIoBaseUpload
     try:
-        message = (service.users().messages().send(userId=user_id, body=message)
+        media = MediaIoBaseUpload(message, mimetype='message/rfc822')
+        message = (service.users().messages().send(userId=user_id, body={}, media_body=media)
                    .execute())
         print(f"Message Id: {message['id']}")
         return message
@@ -1,9 +1,17 @@
 import os
+import concurrent.futures
 from io import BytesIO
 from signage_lib import generate_pdf_bytes, generate_llm_and_original_pdfs
-from gmail_service import get_gmail_service, get_message_content, get_attachment_data, create_message_with_multiple_attachments, send_message, mark_as_read
+from gmail_service import get_gmail_service, get_thread_gmail_service, get_messages_metadata, get_messages_content, get_attachments_data, create_message_with_multiple_attachments, send_message, mark_as_read
 import json
-import base64
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+try:
+    import pybase64 as base64 # SIMD-accelerated drop-in for the stdlib module
+except ImportError:
+    import base64
 
 try:
     import functions_framework
@@ -18,6 +26,27 @@ except Exception as e:
 from env_loader import load_env
 load_env() # Load environment variables for local development
 
+EXCEL_SUFFIXES = ('.xlsx', '.xls', '.xlsm')
+
+# Upper bound on emails processed in parallel by pubsub_handler
+MAX_MESSAGE_WORKERS = 8
+
+def find_excel(parts_list):
+    """
+    Walks the MIME parts tree (depth-first, in order) and returns
+    (attachment_id, filename) of the first Excel attachment, or (None, None).
+    """
+    stack = list(reversed(parts_list))
+    while stack:
+        part = stack.pop()
+        filename = part.get('filename')
+        if filename and filename.lower().endswith(EXCEL_SUFFIXES):
+            attachment_id = part.get('body', {}).get('attachmentId')
+            if attachment_id:
+                return attachment_id, filename
+        stack.extend(reversed(part.get('parts', ())))
+    return None, None
+
 @functions_framework.http
 def generate_signs_http(request):
     """HTTP Cloud Function.
@@ -124,14 +153,12 @@ def pubsub_handler(cloud_event):
     """
     Triggered from a message on a Cloud Pub/Sub topic.
     """
-    import base64
-    import json
-    from gmail_service import get_gmail_service, get_message_content, get_attachment_data, create_message_with_multiple_attachments, send_message, mark_as_read
+    from gmail_service import get_gmail_service, get_thread_gmail_service, get_messages_metadata, get_messages_content, get_attachments_data, create_message_with_multiple_attachments, send_message, mark_as_read
     from signage_lib import generate_llm_and_original_pdfs
     
     # 1. Decode Pub/Sub message
-    pubsub_message = base64.b64decode(cloud_event.data["message"]["data"]).decode()
-    event_data = json.loads(pubsub_message)
+    pubsub_message = base64.b64decode(cloud_event.data["message"]["data"])
+    event_data = json_loads(pubsub_message)
     
     print(f"Received event: {event_data}")
     
@@ -152,32 +179,48 @@ def pubsub_handler(cloud_event):
 
     print(f"Found {len(messages)} unread messages. Checking for attachments...")
 
-    for msg in messages:
+    # Fetch headers for all messages, the full MIME tree only for multipart ones
+    # (the only kind that can carry an attachment), then all Excel attachments.
+    # Each stage is a batched request.
+    msg_metas = get_messages_metadata(service, 'me', [msg['id'] for msg in messages])
+    multipart_ids = [
+        msg_id for msg_id, meta in msg_metas.items()
+        if not isinstance(meta, Exception) and meta.get('payload', {}).get('mimeType', '').startswith('multipart/')
+    ]
+    full_msgs = get_messages_content(service, 'me', multipart_ids) if multipart_ids else {}
+    excel_attachments = {}
+    for msg_id, full_msg in full_msgs.items():
+        if not isinstance(full_msg, Exception):
+            excel_attachments[msg_id] = find_excel(full_msg.get('payload', {}).get('parts', []))
+    attachments_data = get_attachments_data(service, 'me', {
+        msg_id: attachment_id for msg_id, (attachment_id, _) in excel_attachments.items() if attachment_id
+    })
+
+    def process_message(msg):
         msg_id = msg['id']
+        thread_service = None
         sender, subject = 'Unknown', 'No Subject'
         try:
-            full_msg = get_message_content(service, 'me', msg_id)
-            headers = full_msg.get('payload', {}).get('headers', [])
-            subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-            sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown')
+            thread_service = get_thread_gmail_service(service)
+            meta = msg_metas.get(msg_id)
+            if isinstance(meta, Exception):
+                raise meta
+            headers = {h['name']: h['value'] for h in meta.get('payload', {}).get('headers', [])}
+            subject = headers.get('Subject', 'No Subject')
+            sender = headers.get('From', 'Unknown')
             
             print(f"Checking email: {subject} from {sender}")
             
-            # Find Excel attachment
-            def find_excel(parts_list):
-                for part in parts_list:
-                    if part.get('filename') and (part['filename'].endswith('.xlsx') or part['filename'].endswith('.xls')):
-                        return part.get('body', {}).get('attachmentId'), part['filename']
-                    if 'parts' in part:
-                        found_id, found_name = find_excel(part['parts'])
-                        if found_id: return found_id, found_name
-                return None, None
-
-            excel_attachment_id, filename = find_excel(full_msg.get('payload', {}).get('parts', []))
+            full_msg = full_msgs.get(msg_id)
+            if isinstance(full_msg, Exception):
+                raise full_msg
+            excel_attachment_id, filename = excel_attachments.get(msg_id, (None, None))
             
             if excel_attachment_id:
                 print(f"  Found Excel attachment: {filename}")
-                data = get_attachment_data(service, 'me', msg_id, excel_attachment_id)
+                data = attachments_data[msg_id]
+                if isinstance(data, Exception):
+                    raise data
                 excel_file = BytesIO(data)
                 
                 # Generate both PDFs and the Excel tracking file
@@ -190,14 +233,14 @@ def pubsub_handler(cloud_event):
                     reply_msg = create_message_with_multiple_attachments(
                         sender='me', to=sender, subject=reply_subject, body=reply_body, attachments=[]
                     )
-                    send_message(service, 'me', reply_msg)
+                    send_message(thread_service, 'me', reply_msg)
                     print("  Reply sent: No products to print.")
                 else:
                     # Prepare attachments for email
                     attachments = [
-                        {'filename': 'llm_signs.pdf', 'data': llm_pdf.getvalue()},
-                        {'filename': 'original_signs.pdf', 'data': original_pdf.getvalue()},
-                        {'filename': 'generated_names.xlsx', 'data': llm_excel.getvalue()}
+                        {'filename': 'llm_signs.pdf', 'data': llm_pdf},
+                        {'filename': 'original_signs.pdf', 'data': original_pdf},
+                        {'filename': 'generated_names.xlsx', 'data': llm_excel}
                     ]
                     
                     # Reply with attachments
@@ -212,22 +255,29 @@ def pubsub_handler(cloud_event):
                         sender='me', to=sender, subject=reply_subject, body=reply_body, attachments=attachments
                     )
                     
-                    send_message(service, 'me', reply_msg)
+                    send_message(thread_service, 'me', reply_msg)
                     print("  Reply sent with 3 attachments.")
                 
             else:
                 print("  No Excel attachment found. Ignoring email.")
 
-            mark_as_read(service, 'me', msg_id)
+            mark_as_read(thread_service, 'me', msg_id)
 
         except Exception as e:
             print(f"Error processing message {msg_id}: {e}")
+            if thread_service is None:
+                print(f"Critical: Could not send error reply: no Gmail service for message {msg_id}")
+                return
             try:
                 error_body = f"An error occurred while processing your request:\n\n{str(e)}"
                 reply_msg = create_message_with_multiple_attachments(
                     sender='me', to=sender, subject=f"Re: {subject}", body=error_body, attachments=[]
                 )
-                send_message(service, 'me', reply_msg)
-                mark_as_read(service, 'me', msg_id)
+                send_message(thread_service, 'me', reply_msg)
+                mark_as_read(thread_service, 'me', msg_id)
             except Exception as reply_error:
                 print(f"Critical: Could not send error reply: {reply_error}")
+
+    # Messages are independent, so download/PDF generation/reply run concurrently
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_MESSAGE_WORKERS, len(messages))) as executor:
+        list(executor.map(process_message, messages))
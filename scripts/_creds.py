@@ -0,0 +1,88 @@
+"""
+Shared readers/writers for the local OAuth files (token.json, credentials.json),
+so the setup and deploy scripts parse each file at most once per process.
+"""
+import os
+import datetime
+import functools
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# (raw bytes, parsed JSON) keyed by (path, mtime_ns, size)
+_JSON_CACHE = {}
+
+def read_json_file(path):
+    """
+    Returns (raw_bytes, parsed) for the JSON file at path, or None if it does not exist.
+    Parsing is cached until the file's mtime or size changes.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    cache_key = (path, st.st_mtime_ns, st.st_size)
+    cached = _JSON_CACHE.get(cache_key)
+    if cached is None:
+        with open(path, 'rb') as f:
+            raw = f.read()
+        cached = (raw, json_loads(raw))
+        _JSON_CACHE[cache_key] = cached
+    return cached
+
+def load_token(token_path='token.json'):
+    """Returns the parsed token.json dict, or None if the file does not exist."""
+    result = read_json_file(token_path)
+    return result[1] if result else None
+
+def load_client_secrets(path='credentials.json'):
+    """Returns the parsed OAuth client secrets dict, or None if the file does not exist."""
+    result = read_json_file(path)
+    return result[1] if result else None
+
+def token_is_fresh(token_info, margin):
+    """
+    True if token_info (a parsed token.json) holds an access token that is valid
+    for at least `margin` more. Reads the JSON fields directly, so no
+    Credentials object is needed for the common "still fresh" case.
+    """
+    if not token_info.get('token'):
+        return False
+    expiry = token_info.get('expiry')
+    if not expiry:
+        return True # google-auth treats a token without expiry as never expiring
+    try:
+        # google-auth writes a naive UTC isoformat() with a trailing 'Z'
+        expiry = datetime.datetime.fromisoformat(expiry.rstrip('Z'))
+    except ValueError:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return expiry - now >= margin
+
+@functools.lru_cache(maxsize=1)
+def auth_request():
+    """
+    Shared google-auth transport for token refreshes. Reusing one Request keeps
+    its requests.Session (and its pooled TLS connection) across refresh calls.
+    """
+    from google.auth.transport.requests import Request
+    return Request()
+
+def write_token_file(token_path, token_json):
+    """
+    Atomically replaces token_path with token_json (via a temp file + os.replace),
+    so a crash mid-write never leaves a truncated token. Skips the write if the
+    content is unchanged. Returns True if the file was written.
+    """
+    try:
+        current = read_json_file(token_path)
+    except ValueError:
+        current = None # Corrupt file, just overwrite it
+    if current and current[0] == token_json.encode("UTF-8"):
+        return False
+    tmp_path = f"{token_path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(token_json)
+    os.replace(tmp_path, token_path)
+    return True
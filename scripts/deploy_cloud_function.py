@@ -6,9 +6,124 @@ import subprocess
 import json
 import os
 import sys
+import datetime
+import shutil
+import threading
+import time
+import fnmatch
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
+# Add parent directory to path to allow importing env_loader
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _creds import load_token, token_is_fresh, write_token_file, auth_request
+from setup_secret_manager import _sm_client, sync_secret, token_payload, GEMINI_SECRET_ID
+
+# Refresh the local token when it has less than this left before expiry
+TOKEN_REFRESH_SKEW = datetime.timedelta(minutes=5)
+
+# env file keys passed through to the deployed functions as plain env vars
+RUNTIME_ENV_KEYS = ("GCP_PROJECT_ID", "GCP_SECRET_ID", "GCP_SECRET_VERSIONS_TO_KEEP")
+
+# Max number of `gcloud functions deploy` commands run at the same time
+MAX_PARALLEL_DEPLOYS = 10
+
+# Cloud Functions write quota (gen2: ~60 writes/60s); pace deploys to stay under it
+DEPLOY_RATE_PER_SEC = 60 / 60
+DEPLOY_BURST = 10
+
+# Object name of the shared source archive when GCP_DEPLOY_SOURCE_BUCKET is set
+SOURCE_ARCHIVE_NAME = "signage-source.zip"
+
+
+def load_gcloudignore(path='.gcloudignore'):
+    """Returns the patterns from .gcloudignore (comments and directives skipped)."""
+    try:
+        with open(path, 'r') as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line for line in lines if line and not line.startswith(('#', '!'))]
+
+
+def is_ignored(rel_path, is_dir, patterns):
+    """Matches a path against .gcloudignore patterns ('dir/' patterns only match directories)."""
+    name = os.path.basename(rel_path)
+    for pattern in patterns:
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip('/')
+        target = rel_path if '/' in pattern else name
+        if fnmatch.fnmatch(target, pattern.lstrip('/')):
+            return True
+    return False
+
+
+def build_source_archive(zip_path, root='.'):
+    """Zips the function source under root into zip_path, honoring .gcloudignore."""
+    patterns = load_gcloudignore(os.path.join(root, '.gcloudignore'))
+    # compresslevel=1: the archive is transient, so favor speed over size
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            rel_dir = '' if rel_dir == '.' else f"{rel_dir}/"
+            dirnames[:] = [d for d in dirnames if not is_ignored(rel_dir + d, True, patterns)]
+            for filename in filenames:
+                rel_path = rel_dir + filename
+                if not is_ignored(rel_path, False, patterns):
+                    zf.write(os.path.join(dirpath, filename), rel_path)
+
+
+def upload_source_archive(gcloud, bucket):
+    """
+    Zips and uploads the source once so every deploy can use the same gs:// archive.
+    Returns the gs:// URI, or None if the upload failed.
+    """
+    source_uri = f"gs://{bucket}/{SOURCE_ARCHIVE_NAME}"
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        zip_path = os.path.join(tmp_dir, SOURCE_ARCHIVE_NAME)
+        build_source_archive(zip_path)
+        print(f"Uploading source archive to {source_uri}...")
+        try:
+            result = subprocess.run([gcloud, "storage", "cp", zip_path, source_uri])
+        except FileNotFoundError:
+            return None
+    if result.returncode != 0:
+        return None
+    return source_uri
+
+
+@dataclass(frozen=True, slots=True)
+class FunctionSpec:
+    """One Cloud Function to deploy from this source tree."""
+    name: str
+    entry_point: str
+    trigger: tuple
+    memory: str = "512MiB"
+    region: str = "us-central1"
+
+
+FUNCTIONS = (
+    # Pub/Sub trigger, fed by the Gmail watch
+    FunctionSpec("signage-bot", "pubsub_handler", ("--trigger-topic=gmail-watch",)),
+    # HTTP trigger. We KEEP authentication required for security;
+    # Cloud Scheduler must be configured with an OIDC token.
+    FunctionSpec("gmail-watch-renewer", "generate_signs_http", ("--trigger-http",)),
+)
+
+
+def deploy(functions=FUNCTIONS):
+    # Fail fast, before any token refresh or Secret Manager write.
+    # gcloud is a .cmd wrapper on Windows, which only a PATH lookup (or a shell) resolves.
+    gcloud = shutil.which("gcloud")
+    if not gcloud:
+        print("Error: 'gcloud' command not found. Install the Google Cloud SDK and make sure it is on PATH.")
+        return
 
-def deploy():
     # --- LOAD CONFIGURATION ---
     # Defaults
     project_id = "super-home-automation"
@@ -16,20 +131,22 @@ def deploy():
     gemini_key = None
     env_vars = {}
 
-    if os.path.exists('env.yaml'):
-        try:
-            import yaml
-            with open('env.yaml', 'r') as f:
-                env_vars = yaml.safe_load(f) or {}
-                
+    try:
+        from env_loader import read_env_file
+        # env.json (or legacy env.yaml); read_env_file returns None if neither exists
+        loaded = read_env_file()
+        if loaded is not None:
+            env_vars = loaded
             project_id = env_vars.get('GCP_PROJECT_ID', project_id)
             secret_id = env_vars.get('GCP_SECRET_ID', secret_id)
-            if 'GEMINI_API_KEY' in env_vars:
-                gemini_key = json.dumps(env_vars['GEMINI_API_KEY'])
+            if env_vars.get('GEMINI_API_KEY'):
+                gemini_key = str(env_vars['GEMINI_API_KEY'])
                 
             print(f"Configuration loaded. Project: {project_id}, Secret: {secret_id}")
-        except Exception as e:
-            print(f"Warning: Could not read env.yaml: {e}")
+    except Exception as e:
+        print(f"Warning: Could not read env file: {e}")
+    # Same fallback as setup_secret_manager.setup_gemini_secret
+    gemini_key = gemini_key or os.environ.get('GEMINI_API_KEY')
 
     def get_secret_versions_to_keep():
         raw_value = str(env_vars.get("GCP_SECRET_VERSIONS_TO_KEEP", os.environ.get("GCP_SECRET_VERSIONS_TO_KEEP", "3")))
@@ -71,10 +188,6 @@ def deploy():
 
     # --- AUTO-REFRESH AND SYNC TO SECRET MANAGER ---
     try:
-        from google.oauth2.credentials import Credentials
-        from google.auth.transport.requests import Request
-        from google.cloud import secretmanager
-        
         SCOPES = [
             'https://www.googleapis.com/auth/gmail.readonly',
             'https://www.googleapis.com/auth/gmail.send',
@@ -82,45 +195,52 @@ def deploy():
         ]
         
         token_path = "token.json"
-        if os.path.exists(token_path):
+        token_info = load_token(token_path)
+        if token_info is not None:
             print(f"Checking credentials in {token_path}...")
-            creds = Credentials.from_authorized_user_file(token_path, SCOPES)
             
-            if creds.expired and creds.refresh_token:
-                print("Credentials expired. Refreshing...")
-                creds.refresh(Request())
+            # Refresh only when the token is invalid or about to expire; the
+            # expiry check reads token.json directly, without building Credentials
+            if token_is_fresh(token_info, TOKEN_REFRESH_SKEW):
+                print(f"Token fresh (expiry: {token_info.get('expiry')}), skipping refresh.")
+            elif not token_info.get('refresh_token'):
+                print(f"Warning: Token is stale (expiry: {token_info.get('expiry')}) and has no refresh_token, "
+                      "so it cannot be refreshed. Run scripts/setup_oauth.py to re-authorize.")
+            else:
+                from google.oauth2.credentials import Credentials
+
+                creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+                print("Credentials expired or about to expire. Refreshing...")
+                creds.refresh(auth_request())
                 print(f"Token refreshed. New expiry: {creds.expiry}")
                 
                 # Save to local disk
-                with open(token_path, 'w') as f:
-                    f.write(creds.to_json())
-                print("Saved refreshed token to disk.")
+                if write_token_file(token_path, creds.to_json()):
+                    print("Saved refreshed token to disk.")
                 
             # Sync to Secret Manager
             print(f"Syncing token to Secret Manager ({secret_id})...")
-            client = secretmanager.SecretManagerServiceClient()
+            client = _sm_client()
             parent = f"projects/{project_id}/secrets/{secret_id}"
             
             # Validate token.json before uploading
             try:
-                with open(token_path, 'r') as f:
-                    token_content = f.read()
-                    
-                # Parsed just to check validity
-                token_json = json.loads(token_content)
+                # Re-read only if the refresh above rewrote the file; same payload as setup_secret_manager
+                payload, token_json = token_payload(token_path)
                 
                 # Check for critical keys
                 if 'token' not in token_json and 'refresh_token' not in token_json:
                      raise ValueError("Token JSON missing 'token' or 'refresh_token' fields")
 
-                payload = token_content.encode("UTF-8")
-                client.add_secret_version(request={"parent": parent, "payload": {"data": payload}})
-                print(f"Token synced to Secret Manager: {parent}")
+                if not sync_secret(client, project_id, secret_id, payload):
+                    print("Token unchanged in Secret Manager, skipping upload.")
+                else:
+                    print(f"Token synced to Secret Manager: {parent}")
 
-                keep_latest = get_secret_versions_to_keep()
-                destroyed_count = prune_old_secret_versions(client, parent, keep_latest)
-                if destroyed_count:
-                    print(f"Pruned {destroyed_count} old secret version(s), keeping latest {keep_latest}.")
+                    keep_latest = get_secret_versions_to_keep()
+                    destroyed_count = prune_old_secret_versions(client, parent, keep_latest)
+                    if destroyed_count:
+                        print(f"Pruned {destroyed_count} old secret version(s), keeping latest {keep_latest}.")
                 
             except json.JSONDecodeError:
                 print("ERROR: token.json is not valid JSON. Skipping sync to Secret Manager.")
@@ -134,95 +254,131 @@ def deploy():
     except Exception as e:
         print(f"Warning: Token sync failed: {e}. Proceeding with deployment.")
 
-    # Create env file with only GEMINI_API_KEY
-    env_file = "deploy_env.yaml"
-    print(f"Creating {env_file}...")
-    
-    def _yaml_quoted_string(value):
-        # gcloud --env-vars-file requires string values; quote to avoid int/bool coercion.
-        text = str(value).replace("\\", "\\\\").replace('"', '\\"')
-        return f"\"{text}\""
-
-    with open(env_file, 'w') as f:
-        # Write variables loaded earlier
-        if gemini_key:
-            f.write(f"GEMINI_API_KEY: {_yaml_quoted_string(gemini_key)}\n")
-        
-        if 'GCP_PROJECT_ID' in env_vars:
-            f.write(f"GCP_PROJECT_ID: {_yaml_quoted_string(env_vars['GCP_PROJECT_ID'])}\n")
-        if 'GCP_SECRET_ID' in env_vars:
-            f.write(f"GCP_SECRET_ID: {_yaml_quoted_string(env_vars['GCP_SECRET_ID'])}\n")
-        if 'GCP_SECRET_VERSIONS_TO_KEEP' in env_vars:
-            f.write(f"GCP_SECRET_VERSIONS_TO_KEEP: {_yaml_quoted_string(env_vars['GCP_SECRET_VERSIONS_TO_KEEP'])}\n")
-            
-        if (
-            not gemini_key
-            and 'GCP_PROJECT_ID' not in env_vars
-            and 'GCP_SECRET_ID' not in env_vars
-            and 'GCP_SECRET_VERSIONS_TO_KEEP' not in env_vars
-        ):
-            f.write("# No environment variables to write.\n")
-
-    # --- 1. DEPLOY PUBSUB FUNCTION (signage-bot) ---
-    cmd_pubsub = [
-        "gcloud", "functions", "deploy", "signage-bot",
-        "--gen2",
-        "--runtime=python311",
-        "--region=us-central1",
-        "--source=.",
-        "--entry-point=pubsub_handler",
-        "--trigger-topic=gmail-watch",
-        "--project=super-home-automation",
-        "--memory=512MiB",
-        f"--env-vars-file={env_file}"
-    ]
-    
+    # --- GEMINI_API_KEY -> SECRET MANAGER ---
+    # The functions read the key via --set-secrets instead of a plain env var
+    gemini_secret_ok = False
+    if not gemini_key:
+        print("Warning: GEMINI_API_KEY is not set in the env file or environment. "
+              "The deployed functions will start without it and skip LLM name cleaning.")
+    else:
+        try:
+            if sync_secret(_sm_client(), project_id, GEMINI_SECRET_ID, gemini_key.encode("UTF-8")):
+                print(f"Synced GEMINI_API_KEY to Secret Manager ({GEMINI_SECRET_ID}).")
+            gemini_secret_ok = True
+        except Exception as e:
+            print(f"Warning: Could not sync GEMINI_API_KEY to Secret Manager: {e}. Deploying without it.")
+
+    env_args = build_env_args(
+        {key: env_vars[key] for key in RUNTIME_ENV_KEYS if key in env_vars},
+        GEMINI_SECRET_ID if gemini_secret_ok else None,
+    )
+
+    # Upload the source once and point every deploy at it, instead of each
+    # deploy re-zipping and re-uploading the working directory
+    source = "."
+    source_bucket = env_vars.get("GCP_DEPLOY_SOURCE_BUCKET", os.environ.get("GCP_DEPLOY_SOURCE_BUCKET"))
+    if source_bucket:
+        source = upload_source_archive(gcloud, source_bucket)
+        if source is None:
+            print("Warning: Could not upload source archive. Deploying from local directory.")
+            source = "."
+
+    # The deploys are independent, so run them side by side (at most MAX_PARALLEL_DEPLOYS at once)
+    deployments = [(spec.name, build_deploy_cmd(gcloud, spec, env_args, source)) for spec in functions]
+
     print("\n---------------------------------------------------")
-    print("STEP 1: Deploying 'signage-bot' (Pub/Sub Trigger)...")
+    print(f"Deploying {', '.join(repr(spec.name) for spec in functions)}...")
     print("---------------------------------------------------")
-    
-    try:
-        subprocess.check_call(cmd_pubsub, shell=True)
-        print("SUCCESS: 'signage-bot' deployed.")
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: 'signage-bot' deployment failed with exit code {e.returncode}")
-        # Assuming we want to stop if the main bot fails? Or continue?
-        # Let's stop to be safe.
-        if os.path.exists(env_file): os.remove(env_file)
-        return
-    except FileNotFoundError:
-        print("Error: 'gcloud' command not found.")
-        return
 
-    # --- 2. DEPLOY HTTP FUNCTION (gmail-watch-renewer) ---
-    cmd_http = [
-        "gcloud", "functions", "deploy", "gmail-watch-renewer",
+    bucket = TokenBucket(rate=DEPLOY_RATE_PER_SEC, capacity=DEPLOY_BURST)
+
+    def paced_deploy(deployment):
+        bucket.acquire()
+        return run_deploy(*deployment)
+
+    with ThreadPoolExecutor(max_workers=min(MAX_PARALLEL_DEPLOYS, len(deployments))) as executor:
+        return_codes = list(executor.map(paced_deploy, deployments))
+
+    for (name, _), return_code in zip(deployments, return_codes):
+        if return_code == 0:
+            print(f"SUCCESS: '{name}' deployed.")
+        elif return_code is not None:
+            print(f"ERROR: '{name}' deployment failed with exit code {return_code}")
+
+
+def build_env_args(runtime_env, gemini_secret_id=None):
+    """
+    Returns the gcloud flags that set the functions' environment: plain values
+    inline via --set-env-vars, GEMINI_API_KEY as a Secret Manager reference.
+    """
+    args = []
+    if runtime_env:
+        pairs = [f"{key}={value}" for key, value in runtime_env.items()]
+        if any(',' in pair for pair in pairs):
+            # gcloud's alternate-delimiter syntax, for values containing commas
+            args.append("--set-env-vars=^;^" + ";".join(pairs))
+        else:
+            args.append("--set-env-vars=" + ",".join(pairs))
+    else:
+        args.append("--clear-env-vars")
+    if gemini_secret_id:
+        args.append(f"--set-secrets=GEMINI_API_KEY={gemini_secret_id}:latest")
+    return args
+
+
+def build_deploy_cmd(gcloud, spec, env_args, source="."):
+    """Returns the `gcloud functions deploy` argument list for a FunctionSpec."""
+    return [
+        gcloud, "functions", "deploy", spec.name,
         "--gen2",
         "--runtime=python311",
-        "--region=us-central1",
-        "--source=.",
-        "--entry-point=generate_signs_http",
-        "--trigger-http", # Explicitly HTTP
+        f"--region={spec.region}",
+        f"--source={source}",
+        f"--entry-point={spec.entry_point}",
+        *spec.trigger,
         "--project=super-home-automation",
-        "--memory=512MiB",
-        f"--env-vars-file={env_file}"
-        # We KEEP authentication required for security.
-        # User will need to configure Cloud Scheduler with OIDC token.
+        f"--memory={spec.memory}",
+        *env_args
     ]
 
-    print("\n---------------------------------------------------")
-    print("STEP 2: Deploying 'gmail-watch-renewer' (HTTP Trigger)...")
-    print("---------------------------------------------------")
 
+def run_deploy(name, cmd):
+    """
+    Runs one deploy command, streaming its output with a [name] prefix.
+    Returns the exit code, or None if gcloud could not be started.
+    """
     try:
-        subprocess.check_call(cmd_http, shell=True)
-        print("SUCCESS: 'gmail-watch-renewer' deployed.")
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: 'gmail-watch-renewer' deployment failed with exit code {e.returncode}")
-    finally:
-        if os.path.exists(env_file):
-            os.remove(env_file)
-            print(f"Removed {env_file}")
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    except FileNotFoundError:
+        print("Error: 'gcloud' command not found.")
+        return None
+    for line in proc.stdout:
+        print(f"[{name}] {line}", end="")
+    return proc.wait()
+
+
+class TokenBucket:
+    """Thread-safe token bucket: acquire() blocks until a token is available."""
+
+    def __init__(self, rate, capacity):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
 
 if __name__ == "__main__":
     deploy()
@@ -1,6 +1,4 @@
-import os
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.oauth2.credentials import Credentials
+from _creds import load_token, load_client_secrets, write_token_file
 
 # Scopes required for the bot
 SCOPES = [
@@ -13,32 +11,36 @@ def setup_oauth():
     """
     Runs the OAuth flow to generate token.json.
     """
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.oauth2.credentials import Credentials
+
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    token_info = load_token('token.json')
+    if token_info is not None:
+        creds = Credentials.from_authorized_user_info(token_info, SCOPES)
         
     if not creds or not creds.valid:
-        if not os.path.exists('credentials.json'):
+        client_config = load_client_secrets('credentials.json')
+        if client_config is None:
             print("Error: 'credentials.json' not found.")
             print("Please download your OAuth Client ID JSON from GCP Console,")
             print("rename it to 'credentials.json', and place it in this folder.")
             return
 
-        flow = InstalledAppFlow.from_client_secrets_file(
-            'credentials.json', SCOPES)
+        flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
         creds = flow.run_local_server(port=0, prompt='consent', access_type='offline', authorization_prompt_message="")
         
         # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
+        token_json = creds.to_json()
+        write_token_file('token.json', token_json)
             
         print("\nSuccess! 'token.json' has been created.")
         print("You can now use this token to authenticate your Cloud Function.")
         print("Content of token.json (keep this safe!):")
-        print(creds.to_json())
+        print(token_json)
 
 if __name__ == '__main__':
     setup_oauth()
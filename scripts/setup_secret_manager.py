@@ -4,84 +4,148 @@ Run this once before deploying the Cloud Function.
 """
 import json
 import os
+import sys
+import datetime
+import functools
+
+# Add parent directory to path to allow importing env_loader
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from _creds import read_json_file, load_token, token_is_fresh, write_token_file, auth_request
 
 PROJECT_ID = "super-home-automation"
 SECRET_ID = "gmail-oauth-token"
+# Refresh the local token when it has less than this left before expiry
+TOKEN_FRESH_MARGIN = datetime.timedelta(minutes=10)
+# Secret the deployed functions read GEMINI_API_KEY from (--set-secrets)
+GEMINI_SECRET_ID = "gemini-api-key"
+
+@functools.lru_cache(maxsize=1)
+def _sm_client():
+    """Secret Manager client, created on first use and reused (one gRPC channel)."""
+    from google.cloud.secretmanager import SecretManagerServiceClient
+    return SecretManagerServiceClient()
+
+def latest_secret_matches(client, secret_name, payload):
+    """True if the latest version of the secret already holds exactly `payload`."""
+    from google.api_core.exceptions import NotFound
 
-def setup_secret():
-    from google.cloud import secretmanager
-    
-    token_path = "token.json"
-    if not os.path.exists(token_path):
-        print(f"Error: {token_path} not found.")
-        return False
-    
-    with open(token_path, 'r') as f:
-        token_content = f.read().strip()
-    
-    # Validate JSON
     try:
-        json.loads(token_content)
-    except json.JSONDecodeError:
-        print("Error: token.json is not valid JSON.")
+        latest = client.access_secret_version(request={"name": f"{secret_name}/versions/latest"})
+    except NotFound:
+        # Secret (or any version of it) does not exist yet
+        return False
+    return latest.payload.data == payload
+
+def sync_secret(client, project_id, secret_id, payload):
+    """
+    Makes `payload` the latest version of secret_id, creating the secret if needed.
+    Returns True if a new version was added, False if it was already up to date.
+    """
+    from google.api_core.exceptions import AlreadyExists
+
+    secret_name = f"projects/{project_id}/secrets/{secret_id}"
+    if latest_secret_matches(client, secret_name, payload):
         return False
-    
-    client = secretmanager.SecretManagerServiceClient()
-    parent = f"projects/{PROJECT_ID}"
-    
-    # Try to create the secret (will fail if it already exists, which is fine)
     try:
         client.create_secret(
             request={
-                "parent": parent,
-                "secret_id": SECRET_ID,
+                "parent": f"projects/{project_id}",
+                "secret_id": secret_id,
                 "secret": {"replication": {"automatic": {}}},
             }
         )
-        print(f"Created secret: {SECRET_ID}")
-    except Exception as e:
-        if "ALREADY_EXISTS" in str(e):
-            print(f"Secret '{SECRET_ID}' already exists. Adding new version...")
-        else:
-            print(f"Error creating secret: {e}")
-            return False
+        print(f"Created secret: {secret_id}")
+    except AlreadyExists:
+        pass
+    client.add_secret_version(request={"parent": secret_name, "payload": {"data": payload}})
+    return True
+
+def setup_gemini_secret():
+    """Uploads GEMINI_API_KEY from env.json/env.yaml to the GEMINI_SECRET_ID secret."""
+    from env_loader import read_env_file
+
+    env_vars = read_env_file() or {}
+    gemini_key = env_vars.get('GEMINI_API_KEY', os.environ.get('GEMINI_API_KEY'))
+    if not gemini_key:
+        print("GEMINI_API_KEY not set in env file. Skipping Gemini secret.")
+        return False
+
+    if sync_secret(_sm_client(), PROJECT_ID, GEMINI_SECRET_ID, str(gemini_key).encode("UTF-8")):
+        print(f"Uploaded GEMINI_API_KEY to secret '{GEMINI_SECRET_ID}'.")
+    else:
+        print(f"GEMINI_API_KEY unchanged in secret '{GEMINI_SECRET_ID}', skipping upload.")
+    return True
+
+def token_payload(token_path="token.json"):
+    """
+    Returns (payload, parsed) for token.json, or None if it doesn't exist: payload is the
+    exact bytes stored in Secret Manager. setup and deploy both upload this, so
+    latest_secret_matches compares like with like. Raises json.JSONDecodeError on bad JSON.
+    """
+    token_file = read_json_file(token_path)
+    if token_file is None:
+        return None
+    raw, parsed = token_file
+    return raw.strip(), parsed
+
+def setup_secret():
+    token_path = "token.json"
     
-    # Add the token as a new version
-    secret_name = f"projects/{PROJECT_ID}/secrets/{SECRET_ID}"
-    payload = token_content.encode("UTF-8")
+    # Read + validate JSON
+    try:
+        token = token_payload(token_path)
+    except json.JSONDecodeError:
+        print("Error: token.json is not valid JSON.")
+        return False
+    if token is None:
+        print(f"Error: {token_path} not found.")
+        return False
     
-    response = client.add_secret_version(
-        request={"parent": secret_name, "payload": {"data": payload}}
-    )
-    print(f"Added secret version: {response.name}")
-    print("Setup complete! You can now deploy the Cloud Function.")
+    try:
+        added = sync_secret(_sm_client(), PROJECT_ID, SECRET_ID, token[0])
+    except Exception as e:
+        print(f"Error uploading token to secret '{SECRET_ID}': {e}")
+        return False
+    if added:
+        print(f"Added new version of secret '{SECRET_ID}'.")
+        print("Setup complete! You can now deploy the Cloud Function.")
+    else:
+        print(f"Token unchanged in Secret Manager ({SECRET_ID}), skipping upload.")
     return True
 
 if __name__ == "__main__":
     # First, refresh the token if needed
     try:
-        from google.oauth2.credentials import Credentials
-        from google.auth.transport.requests import Request
-        
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.send',
-            'https://www.googleapis.com/auth/gmail.modify' 
-        ]
-        
         print("Checking local token...")
-        creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+        token_info = load_token("token.json")
         
-        if creds.expired and creds.refresh_token:
-            print("Token expired. Refreshing...")
-            creds.refresh(Request())
-            with open("token.json", 'w') as f:
-                f.write(creds.to_json())
-            print(f"Token refreshed. New expiry: {creds.expiry}")
+        # Only build Credentials (and import google-auth) when a refresh may be needed
+        if token_info is None:
+            print("Error: token.json not found. Run scripts/setup_oauth.py first.")
+            sys.exit(1)
+        elif token_is_fresh(token_info, TOKEN_FRESH_MARGIN):
+            print(f"Token is valid. Expiry: {token_info.get('expiry')}")
         else:
-            print(f"Token is valid. Expiry: {creds.expiry}")
+            from google.oauth2.credentials import Credentials
+            
+            SCOPES = [
+                'https://www.googleapis.com/auth/gmail.readonly',
+                'https://www.googleapis.com/auth/gmail.send',
+                'https://www.googleapis.com/auth/gmail.modify' 
+            ]
+            
+            creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+            if creds.refresh_token:
+                print("Token expired or about to expire. Refreshing...")
+                creds.refresh(auth_request())
+                write_token_file("token.json", creds.to_json())
+                print(f"Token refreshed. New expiry: {creds.expiry}")
+            else:
+                print(f"Token has no refresh_token, cannot refresh. Expiry: {creds.expiry}")
             
     except Exception as e:
         print(f"Warning: Could not refresh token: {e}")
     
     setup_secret()
+    setup_gemini_secret()
@@ -4,12 +4,12 @@ import os
 # Add parent directory to path to allow importing gmail_service
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from gmail_service import get_gmail_service
-
 def setup_watch(topic_name):
     """
     Tells Gmail to push notifications to the specified Pub/Sub topic.
     """
+    from gmail_service import get_gmail_service
+
     try:
         service = get_gmail_service(token_json_path='token.json')
         
@@ -13,40 +13,52 @@ from reportlab.lib.colors import HexColor, white, Color
 from reportlab.lib.units import cm
 from io import BytesIO
 import json
-from google import genai
-from google.genai import types
-import copy
+import functools
+import hashlib
+import time
+import itertools
+import concurrent.futures
+import sqlite3
+import tempfile
+from contextlib import closing
 from google.cloud import firestore
+try:
+    import python_calamine # noqa: F401  Rust xlsx reader, several times faster than openpyxl
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = None # pandas default (openpyxl)
+from google.api_core import exceptions as gcp_exceptions
 
 from env_loader import load_env
 load_env() # Load environment variables for local development
 
 # --- LLM Configuration ---
 API_KEY = os.environ.get("GEMINI_API_KEY")
+model_name = 'gemini-flash-latest' # Original model requested
 
-if API_KEY:
+@functools.lru_cache(maxsize=1)
+def _gemini():
+    """
+    Returns (client, generate_config, retry_config), or None if Gemini is not configured.
+    Created on first use: google-genai is by far the slowest import in this module, and
+    runs with nothing new to print (or only cached names) never need it.
+    """
+    if not API_KEY:
+        print("Warning: GEMINI_API_KEY environment variable not set. LLM features will be disabled.")
+        return None
     try:
+        from google import genai
+        from google.genai import types
+
         client = genai.Client(api_key=API_KEY)
-        # We will use this client for generation calls
-        # model object isn't persisted the same way in new SDK, just the client
-        model_name = 'gemini-flash-latest' # Original model requested
-        
-        # Configure Search Tool
-        grounding_tool = types.Tool(
-            google_search=types.GoogleSearch()
-        )
-        generate_config = types.GenerateContentConfig(
-            tools=[grounding_tool]
-        )
-        
+        # Attempt 1 uses the Google Search tool; the retry forces plain JSON output instead
+        generate_config = types.GenerateContentConfig(tools=[types.Tool(google_search=types.GoogleSearch())])
+        retry_config = types.GenerateContentConfig(response_mime_type='application/json')
         print(f"Selected Model: {model_name} with Google Search (New SDK)")
-        
+        return client, generate_config, retry_config
     except Exception as e:
         print(f"Error: Could not initialize Gemini Client: {e}. LLM features will be disabled.")
-        client = None
-else:
-    client = None
-    print("Warning: GEMINI_API_KEY environment variable not set. LLM features will be disabled.")
+        return None
 
 
 # --- Constants & Config ---
@@ -55,6 +67,19 @@ SIGN_HEIGHT_CM = 3.6
 SIGN_WIDTH = SIGN_WIDTH_CM * cm
 SIGN_HEIGHT = SIGN_HEIGHT_CM * cm
 
+# Layout (offsets from a sign's bottom-left corner). The design is drawn on a
+# 102-unit-wide grid with y measured from the top, scaled to SIGN_WIDTH.
+LAYOUT_SCALE = SIGN_WIDTH / 102.0
+GOLD_STRIP_DX = 2 * LAYOUT_SCALE
+GOLD_STRIP_W, GOLD_STRIP_H = 60 * LAYOUT_SCALE, 1 * LAYOUT_SCALE
+GOLD_TOP_DY = SIGN_HEIGHT - (2 * LAYOUT_SCALE) - GOLD_STRIP_H
+GOLD_BOTTOM_DY = SIGN_HEIGHT - (33 * LAYOUT_SCALE) - GOLD_STRIP_H
+WHITE_BOX_W, WHITE_BOX_H = 34 * LAYOUT_SCALE, 30 * LAYOUT_SCALE
+WHITE_BOX_DX = 66 * LAYOUT_SCALE
+WHITE_BOX_DY = SIGN_HEIGHT - (3 * LAYOUT_SCALE) - WHITE_BOX_H
+PRICE_CENTER_DX = 33 * LAYOUT_SCALE
+SALE_ROTATE_COS = SALE_ROTATE_SIN = math.sqrt(0.5) # "Sale" ribbon text angle: 45°
+
 # Colors
 BG_COLOR = HexColor('#254778')
 PATTERN_COLOR = HexColor('#1e3a61')
@@ -71,8 +96,17 @@ FONT_REGULAR = 'Heebo-Regular'
 FONT_BOLD = 'Heebo-Bold'
 FONT_EXTRA_BOLD = 'Heebo-ExtraBold'
 
+# Result of the first register_fonts() call (None = not attempted yet)
+_FONTS_REGISTERED = None
+
 def register_fonts():
     """Registers fonts if available, otherwise falls back to Helvetica."""
+    global _FONTS_REGISTERED
+    if _FONTS_REGISTERED is None:
+        _FONTS_REGISTERED = _register_fonts()
+    return _FONTS_REGISTERED
+
+def _register_fonts():
     try:
         # Check if font files exist before registering
         reg_path = os.path.join(FONTS_DIR, 'Heebo-Regular.ttf')
@@ -98,35 +132,71 @@ def draw_diagonal_hatch(c, x, y, width, height):
     c.clipPath(path, stroke=0)
     c.setStrokeColor(PATTERN_COLOR)
     c.setLineWidth(0.5)
-    step = 3
-    max_dim = width + height
-    start_offset = -height
-    end_offset = width
-    for i in range(int(start_offset), int(end_offset), step):
-        c.line(x + i, y, x + i + max_dim, y + max_dim)
+    # One path with all segments: a single stroke operator instead of one per line
+    c.lines([(x + x1, y, x + x2, y + y2) for x1, x2, y2 in _hatch_segments(width, height)])
     c.restoreState()
 
-def draw_gold_gradient_rect(c, x, y, width, height):
-    """Draws a rectangle with a linear gradient: Dark -> Light -> Dark"""
-    c.saveState()
-    path = c.beginPath()
-    path.rect(x, y, width, height)
-    c.clipPath(path, stroke=0)
-    steps = 50
-    step_width = width / steps
+@functools.lru_cache(maxsize=16)
+def _hatch_segments(width, height, step=3):
+    """(x1, x2, y2) offsets of the hatch lines for a width x height box (lines start at y=0)."""
+    max_dim = width + height
+    return tuple((i, i + max_dim, max_dim) for i in range(int(-height), int(width), step))
+
+def _gold_gradient_colors(steps):
+    """The constant Dark -> Light -> Dark gold ramp, one Color per gradient step."""
+    colors = []
     for i in range(steps):
         ratio = i / (steps - 1)
         if ratio < 0.5:
             local_r, c1, c2 = ratio * 2, GOLD_START, GOLD_MID
         else:
             local_r, c1, c2 = (ratio - 0.5) * 2, GOLD_MID, GOLD_END
-        r, g, b = (c1.red + (c2.red - c1.red) * local_r,
-                   c1.green + (c2.green - c1.green) * local_r,
-                   c1.blue + (c2.blue - c1.blue) * local_r)
-        c.setFillColor(Color(r, g, b))
-        c.rect(x + i * step_width, y, step_width + 0.5, height, fill=1, stroke=0)
+        colors.append(Color(c1.red + (c2.red - c1.red) * local_r,
+                            c1.green + (c2.green - c1.green) * local_r,
+                            c1.blue + (c2.blue - c1.blue) * local_r))
+    return colors
+
+GOLD_GRADIENT_COLORS = _gold_gradient_colors(50)
+
+def draw_gold_gradient_rect(c, x, y, width, height):
+    """Draws a rectangle with a linear gradient: Dark -> Light -> Dark"""
+    step_width = width / len(GOLD_GRADIENT_COLORS)
+    last = len(GOLD_GRADIENT_COLORS) - 1
+    for i, color in enumerate(GOLD_GRADIENT_COLORS):
+        c.setFillColor(color)
+        # Steps overlap by 0.5pt to avoid hairline seams; the last one stops exactly
+        # at the right edge, so no clip path (or saveState) is needed
+        c.rect(x + i * step_width, y, step_width + (0.5 if i < last else 0), height, fill=1, stroke=0)
+
+def _draw_as_form(c, name, draw_fn, x, y, width, height):
+    """
+    Draws draw_fn(c, 0, 0, width, height) at (x, y) through a reusable Form XObject.
+    The form is recorded the first time `name` is used in a document; every later sign
+    only emits a reference to it instead of repeating the drawing operators.
+    """
+    if not c.hasForm(name):
+        c.beginForm(name, 0, 0, width, height)
+        draw_fn(c, 0, 0, width, height)
+        c.endForm()
+    c.saveState()
+    c.translate(x, y)
+    c.doForm(name)
     c.restoreState()
 
+def draw_sign_hatch(c, x, y):
+    """The diagonal hatch over a whole sign, shared by every sign in the document."""
+    _draw_as_form(c, 'signHatch', draw_diagonal_hatch, x, y, SIGN_WIDTH, SIGN_HEIGHT)
+
+def draw_gold_strip(c, x, y, width=GOLD_STRIP_W, height=GOLD_STRIP_H, name='goldStrip'):
+    """A gold gradient strip, shared by every strip of the same size in the document."""
+    _draw_as_form(c, name, draw_gold_gradient_rect, x, y, width, height)
+
+@functools.lru_cache(maxsize=8192)
+def _string_width(text, font_name, font_size):
+    """pdfmetrics.stringWidth, memoized: prices, symbols and words repeat across signs."""
+    return pdfmetrics.stringWidth(text, font_name, font_size)
+
+@functools.lru_cache(maxsize=8192)
 def reshape_text(text):
     if not text: return ""
     return get_display(arabic_reshaper.reshape(str(text)))
@@ -134,16 +204,21 @@ def reshape_text(text):
 def draw_wrapped_text(c, text, x, y, width, height, font_name, font_size, line_height=14):
     """Draws text wrapped within a box, centered vertically and horizontally."""
     words = text.split()
+    # Reshaping is per word (joining never crosses a space) and width doesn't depend on
+    # BiDi order, so a line's width is the sum of its reshaped words' widths plus the
+    # spaces. Each word is measured once and the line width is tracked incrementally.
+    space_w = _string_width(" ", font_name, font_size)
     lines = []
-    current_line = []
+    current_line, current_w = [], 0
     c.setFont(font_name, font_size)
     for word in words:
-        test_line = " ".join(current_line + [word])
-        if c.stringWidth(reshape_text(test_line), font_name, font_size) <= width:
-            current_line.append(word)
+        word_w = _string_width(reshape_text(word), font_name, font_size)
+        new_w = current_w + space_w + word_w if current_line else word_w
+        if new_w <= width:
+            current_line.append(word); current_w = new_w
         else:
             if current_line: lines.append(" ".join(current_line))
-            current_line = [word]
+            current_line, current_w = [word], word_w
     if current_line: lines.append(" ".join(current_line))
     max_lines = int(height / line_height)
     if len(lines) > max_lines: lines = lines[:max_lines]
@@ -156,18 +231,16 @@ def draw_wrapped_text(c, text, x, y, width, height, font_name, font_size, line_h
 def draw_price_styled(c, x, y, price_val, font_main, main_size, color, stroke_color=None, stroke_width=0):
     """Draws price with smaller shekel and decimals. Optional strikethrough."""
     try: price_float = float(price_val)
-    except: price_float = 0.0
+    except (ValueError, TypeError): price_float = 0.0
     price_str = f"{price_float:.2f}"
     main_digits, decimal_part = price_str.split('.') if '.' in price_str else (price_str, "")
     if decimal_part: decimal_part = f".{decimal_part}"
     sub_size = main_size * 0.5
     c.setFillColor(color)
-    # Calculate widths
-    c.setFont(FONT_REGULAR, sub_size)
-    w_shekel = c.stringWidth("₪", FONT_REGULAR, sub_size)
-    w_dec = c.stringWidth(decimal_part, font_main, sub_size)
-    c.setFont(font_main, main_size)
-    w_main = c.stringWidth(main_digits, font_main, main_size)
+    # Calculate widths (stringWidth takes the font explicitly, no setFont needed)
+    w_shekel = _string_width("₪", FONT_REGULAR, sub_size)
+    w_dec = _string_width(decimal_part, font_main, sub_size)
+    w_main = _string_width(main_digits, font_main, main_size)
     gap = 2
     total_width = w_shekel + gap + w_main + gap + w_dec
     # Draw starting at x
@@ -198,11 +271,10 @@ def draw_discount_sign(c, x, y, data):
     # 1. Background (Standard)
     c.setFillColor(BG_COLOR)
     c.rect(x, y, SIGN_WIDTH, SIGN_HEIGHT, fill=1, stroke=0)
-    draw_diagonal_hatch(c, x, y, SIGN_WIDTH, SIGN_HEIGHT)
+    draw_sign_hatch(c, x, y)
     
     # 3. White Box (Right) - Same as standard
-    scale = SIGN_WIDTH / 102.0
-    wx, wy, ww, wh = x + (66 * scale), y + SIGN_HEIGHT - (3 * scale) - (30 * scale), 34 * scale, 30 * scale
+    wx, wy, ww, wh = x + WHITE_BOX_DX, y + WHITE_BOX_DY, WHITE_BOX_W, WHITE_BOX_H
     c.setFillColor(WHITE_COLOR)
     c.roundRect(wx, wy, ww, wh, 0, fill=1, stroke=0)
     
@@ -221,8 +293,8 @@ def draw_discount_sign(c, x, y, data):
     # Gold Strip and Previous Price (Crossed Out)
     if prev_price_val:
         # Gold Strip
-        strip_y, strip_h, strip_w, strip_x = y + 1.1 * cm, 0.1 * cm, 60 * scale, x + (2 * scale)
-        draw_gold_gradient_rect(c, strip_x, strip_y, strip_w, strip_h)
+        strip_y, strip_h, strip_w, strip_x = y + 1.1 * cm, 0.1 * cm, GOLD_STRIP_W, x + GOLD_STRIP_DX
+        draw_gold_strip(c, strip_x, strip_y, strip_w, strip_h, name='goldStripThin')
         # Previous Price
         prev_price_y, prev_price_x = y + 0.5 * cm, x + 2.0 * cm
         draw_price_styled(c, prev_price_x, prev_price_y, prev_price_val, f_bold, 14, HexColor('#B0BEC5'), stroke_color=SALE_COLOR, stroke_width=1.5)
@@ -230,20 +302,25 @@ def draw_discount_sign(c, x, y, data):
     else:
         draw_price_styled(c, current_price_x - 10, current_price_y - 10, price_val, f_extra, 45, white)
         # No previous price: Draw Top and Bottom Gold Stripes (Standard Style)
-        gw, gh = 60 * scale, 1 * scale
-        draw_gold_gradient_rect(c, x + (2 * scale), y + SIGN_HEIGHT - (3 * scale), gw, gh)
-        draw_gold_gradient_rect(c, x + (2 * scale), y + SIGN_HEIGHT - (34 * scale), gw, gh)
+        draw_gold_strip(c, x + GOLD_STRIP_DX, y + GOLD_TOP_DY)
+        draw_gold_strip(c, x + GOLD_STRIP_DX, y + GOLD_BOTTOM_DY)
 
-    # 2. "Sale" Ribbon (Diagonal Band)
-    c.saveState()
+    # 2. "Sale" Ribbon (Diagonal Band), filled in page coordinates
     tl_x, tl_y = x, y + SIGN_HEIGHT
     d_in, d_out = 1 * cm, 1 * cm + (1 * cm * 1.414)
     path = c.beginPath(); path.moveTo(tl_x, tl_y - d_in); path.lineTo(tl_x, tl_y - d_out); path.lineTo(tl_x + d_out, tl_y); path.lineTo(tl_x + d_in, tl_y); path.close()
     c.setFillColor(SALE_COLOR); c.drawPath(path, fill=1, stroke=0)
-    # Text "מבצע!"
+    # Text "מבצע!", rotated 45° via the text matrix (scoped to the text object,
+    # so no saveState/translate/rotate/restoreState is needed)
     cx, cy = tl_x + ((d_in + d_out) / 4), tl_y - ((d_in + d_out) / 4)
-    c.translate(cx, cy); c.rotate(45); c.setFillColor(white); c.setFont(f_reg, 20); c.drawCentredString(0, -7, reshape_text("מבצע!"))
-    c.restoreState()
+    label = reshape_text("מבצע!")
+    # Centred at (0, -7) in the rotated frame, as drawCentredString would
+    dx, dy = -_string_width(label, f_reg, 20) / 2, -7
+    text = c.beginText()
+    text.setTextTransform(SALE_ROTATE_COS, SALE_ROTATE_SIN, -SALE_ROTATE_SIN, SALE_ROTATE_COS,
+                          cx + dx * SALE_ROTATE_COS - dy * SALE_ROTATE_SIN, cy + dx * SALE_ROTATE_SIN + dy * SALE_ROTATE_COS)
+    text.setFont(f_reg, 20); text.setFillColor(white); text.textOut(label)
+    c.drawText(text)
 
 def draw_sign(c, x, y, data, use_heebo=True):
     """Draws a single sign at (x, y)."""
@@ -251,26 +328,24 @@ def draw_sign(c, x, y, data, use_heebo=True):
     # 1. Background
     c.setFillColor(BG_COLOR); c.rect(x, y, SIGN_WIDTH, SIGN_HEIGHT, fill=1, stroke=0)
     # 2. Pattern Overlay
-    draw_diagonal_hatch(c, x, y, SIGN_WIDTH, SIGN_HEIGHT)
+    draw_sign_hatch(c, x, y)
     # 3. Gold Stripes
-    scale = SIGN_WIDTH / 102.0
-    to_rl = lambda svg_x, svg_y, svg_h=0: (x + (svg_x * scale), y + SIGN_HEIGHT - (svg_y * scale) - (svg_h * scale))
-    gw, gh = 60 * scale, 1 * scale
-    draw_gold_gradient_rect(c, *to_rl(2, 2, 1), gw, gh); draw_gold_gradient_rect(c, *to_rl(2, 33, 1), gw, gh)
+    draw_gold_strip(c, x + GOLD_STRIP_DX, y + GOLD_TOP_DY)
+    draw_gold_strip(c, x + GOLD_STRIP_DX, y + GOLD_BOTTOM_DY)
     # 4. White Box (Right)
-    wx, wy, ww, wh = *to_rl(66, 3, 30), 34 * scale, 30 * scale
+    wx, wy, ww, wh = x + WHITE_BOX_DX, y + WHITE_BOX_DY, WHITE_BOX_W, WHITE_BOX_H
     c.setFillColor(WHITE_COLOR); c.roundRect(wx, wy, ww, wh, 0, fill=1, stroke=0)
     # --- Content: Price (Left) ---
     try: price_float = float(data.get('price', 0))
     except (ValueError, TypeError): price_float = 0.0
     main_digits, decimal_part = f"{price_float:.2f}".split('.'); decimal_part = f".{decimal_part}"
     base_font_size, sub_size = 50, 25
-    price_center_x, price_center_y = x + (33 * scale), y + (SIGN_HEIGHT / 2) - (base_font_size * 0.35)
-    c.setFillColor(WHITE_COLOR); c.setFont(f_extra, base_font_size)
-    w_main = c.stringWidth(main_digits, f_extra, base_font_size)
-    c.setFont(f_extra, sub_size); w_dec = c.stringWidth(decimal_part, f_extra, sub_size)
+    price_center_x, price_center_y = x + PRICE_CENTER_DX, y + (SIGN_HEIGHT / 2) - (base_font_size * 0.35)
+    c.setFillColor(WHITE_COLOR)
+    w_main = _string_width(main_digits, f_extra, base_font_size)
+    w_dec = _string_width(decimal_part, f_extra, sub_size)
     # Shekel with Regular Font
-    c.setFont(f_reg, sub_size); w_shekel = c.stringWidth("₪", f_reg, sub_size)
+    w_shekel = _string_width("₪", f_reg, sub_size)
     gap = 2; total_w = w_shekel + gap + w_main + gap + w_dec
     cur_x = price_center_x - (total_w / 2)
     # Draw Shekel, Main, Decimals
@@ -287,28 +362,16 @@ def draw_sign(c, x, y, data, use_heebo=True):
     draw_wrapped_text(c, str(data.get('name', '')), wx, text_area_y, ww - 4, text_area_h, f_bold, 12)
 
 # --- LLM Name Cleaning ---
-def clean_product_names_batch(dirty_names):
-    """
-    Sends a list of product names to Gemini and returns a {dirty: cleaned} map.
-    """
-    if not client:
-        print("LLM model not configured. Skipping name cleaning.")
-        return {name: name for name in dirty_names}
-    
-    # Load few-shot examples
-    examples_str = ""
-    try:
-        examples_path = os.path.join(os.path.dirname(__file__), 'few_shot_examples.json')
-        if os.path.exists(examples_path):
-            with open(examples_path, 'r', encoding='utf-8') as f:
-                examples_data = json.load(f)
-                # Take a subset of examples to save tokens if needed, e.g., first 10 and last 5
-                # or just use all if the list isn't huge. The current list is ~50 items, which fits fine.
-                examples_str = json.dumps(examples_data, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"Warning: Could not load few-shot examples: {e}")
-
-    prompt = f"""
+LLM_CHUNK_SIZE = 25 # Names per Gemini request
+LLM_MAX_WORKERS = 8 # Concurrent Gemini requests
+# Persistent {raw name: cleaned name} cache, so a name is only paid for once across runs.
+# Entries are keyed by _name_cache_version() as well as the raw name.
+# Defaults to the temp dir, the only writable location on Cloud Functions.
+NAME_CACHE_PATH = os.environ.get('NAME_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'signage_name_cache.sqlite3'))
+SQLITE_MAX_PARAMS = 500 # Names per SELECT ... IN (...) lookup
+
+# Gemini prompt for _clean_names_chunk, formatted with the few-shot examples and input names
+_NAME_PROMPT = """
     You are an expert retail copywriter for a high-end home goods store.
     Your task is to reformat and clean raw product names from an ERP system for display on elegant customized shelf signage.
 
@@ -327,17 +390,109 @@ def clean_product_names_batch(dirty_names):
     7. **JSON Output**: You must return ONLY a JSON object mapping Original Name -> Cleaned Name.
 
     ### Few-Shot Examples (Learn from these patterns)
-    {examples_str}
+    {examples}
 
     ### Input List (Clean these)
-    {json.dumps(dirty_names, ensure_ascii=False)}
+    {names}
 
     ### Output JSON
     """
-    retry_config = types.GenerateContentConfig(
-        response_mime_type='application/json'
-    )
 
+def _name_cache_version():
+    """Hash of everything that shapes a cleaned name, so changing the model, prompt or examples invalidates the cache."""
+    key = "\0".join((model_name, _NAME_PROMPT, _few_shot_examples_str()))
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+def _open_name_cache():
+    conn = sqlite3.connect(NAME_CACHE_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS cleaned_names (version TEXT NOT NULL, raw TEXT NOT NULL, cleaned TEXT NOT NULL, PRIMARY KEY (version, raw))")
+    return conn
+
+def _cached_names(names):
+    """Returns {raw: cleaned} for the names already in the cache. Cache errors are non-fatal."""
+    hits = {}
+    version = _name_cache_version()
+    try:
+        with closing(_open_name_cache()) as conn:
+            for i in range(0, len(names), SQLITE_MAX_PARAMS):
+                chunk = names[i:i + SQLITE_MAX_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                hits.update(conn.execute(f"SELECT raw, cleaned FROM cleaned_names WHERE version = ? AND raw IN ({placeholders})", [version, *chunk]))
+    except sqlite3.Error as e:
+        print(f"Warning: Could not read name cache: {e}")
+    return hits
+
+def _store_cleaned_names(cleaned_map):
+    if not cleaned_map:
+        return
+    version = _name_cache_version()
+    try:
+        with closing(_open_name_cache()) as conn, conn:
+            conn.executemany("INSERT OR REPLACE INTO cleaned_names (version, raw, cleaned) VALUES (?, ?, ?)",
+                             ((version, raw, cleaned) for raw, cleaned in cleaned_map.items()))
+    except sqlite3.Error as e:
+        print(f"Warning: Could not write name cache: {e}")
+
+def clean_product_names_batch(dirty_names):
+    """
+    Sends a list of product names to Gemini and returns a {dirty: cleaned} map.
+    Names found in the name cache are not sent again. The rest are split into chunks
+    of LLM_CHUNK_SIZE that are cleaned concurrently.
+    """
+    cleaned = _cached_names(dirty_names)
+    misses = [name for name in dirty_names if name not in cleaned]
+    if cleaned:
+        print(f"Name cache: {len(cleaned)} hits, {len(misses)} names left to clean.")
+    if not misses:
+        return cleaned
+    if not _gemini():
+        print("LLM model not configured. Skipping name cleaning.")
+        cleaned.update({name: name for name in misses})
+        return cleaned
+
+    chunks = [misses[i:i + LLM_CHUNK_SIZE] for i in range(0, len(misses), LLM_CHUNK_SIZE)]
+    if len(chunks) == 1:
+        results = [_clean_names_chunk(misses)]
+    else:
+        print(f"Cleaning {len(misses)} names in {len(chunks)} parallel requests...")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(LLM_MAX_WORKERS, len(chunks))) as executor:
+            results = list(executor.map(_clean_names_chunk, chunks))
+
+    fresh = {}
+    for chunk, chunk_result in zip(chunks, results):
+        if chunk_result is None:
+            # Failed chunk: fall back to the original names, and don't cache them
+            cleaned.update({name: name for name in chunk})
+            continue
+        cleaned.update(chunk_result)
+        fresh.update({name: chunk_result[name] for name in chunk if isinstance(chunk_result.get(name), str)})
+    _store_cleaned_names(fresh)
+    return cleaned
+
+@functools.lru_cache(maxsize=1)
+def _few_shot_examples_str():
+    """The few-shot examples as pretty JSON for the prompt (loaded once per process)."""
+    try:
+        examples_path = os.path.join(os.path.dirname(__file__), 'few_shot_examples.json')
+        if os.path.exists(examples_path):
+            with open(examples_path, 'r', encoding='utf-8') as f:
+                examples_data = json.load(f)
+                # Take a subset of examples to save tokens if needed, e.g., first 10 and last 5
+                # or just use all if the list isn't huge. The current list is ~50 items, which fits fine.
+                return json.dumps(examples_data, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"Warning: Could not load few-shot examples: {e}")
+    return ""
+
+def _clean_names_chunk(dirty_names):
+    """
+    Cleans one chunk of names with a single Gemini request (plus one forced-JSON retry).
+    Returns the {dirty: cleaned} map, or None if both attempts failed.
+    """
+    client, generate_config, retry_config = _gemini()
+    examples_str = _few_shot_examples_str()
+
+    prompt = _NAME_PROMPT.format(examples=examples_str, names=json.dumps(dirty_names, ensure_ascii=False))
     # Attempt 1: With Search Tool (Standard)
     try:
         response = client.models.generate_content(
@@ -369,7 +524,10 @@ def clean_product_names_batch(dirty_names):
         print(f"Error in Attempt 2: {e}")
 
     print("All attempts failed. Returning original names.")
-    return {name: name for name in dirty_names}
+    return None
+
+# Markdown code fence around a response: ```json\n...\n``` (closing fence optional)
+_FENCE_RE = re.compile(r'^```[^\n]*\n(.*?)(?:```)?$', re.DOTALL)
 
 def _parse_and_validate_llm_response(text, attempt_name):
     """
@@ -378,12 +536,8 @@ def _parse_and_validate_llm_response(text, attempt_name):
     try:
         # Clean markdown code blocks if present
         cleaned_text = text.strip()
-        if cleaned_text.startswith("```"):
-            first_newline = cleaned_text.find("\n")
-            if first_newline != -1:
-                cleaned_text = cleaned_text[first_newline+1:]
-            if cleaned_text.endswith("```"):
-                cleaned_text = cleaned_text[:-3]
+        if m := _FENCE_RE.match(cleaned_text):
+            cleaned_text = m.group(1)
         cleaned_text = cleaned_text.strip()
         
         data = json.loads(cleaned_text)
@@ -403,13 +557,10 @@ def _parse_and_validate_llm_response(text, attempt_name):
             success = True
             for item in data:
                 if isinstance(item, dict):
-                    # check for common keys
-                    keys = [k.lower() for k in item.keys()]
+                    # check for common keys (case-insensitive)
+                    keys = {k.lower(): k for k in item}
                     if 'original' in keys and 'cleaned' in keys:
-                            # find exact keys
-                            orig_k = next(k for k in item.keys() if k.lower() == 'original')
-                            clean_k = next(k for k in item.keys() if k.lower() == 'cleaned')
-                            recovered_map[item[orig_k]] = item[clean_k]
+                            recovered_map[item[keys['original']]] = item[keys['cleaned']]
                     else:
                             # Maybe it's a list of single-key dicts? {orig: clean}
                             for k, v in item.items():
@@ -436,27 +587,129 @@ def _create_pdf_from_products(products, use_heebo):
     """
     Helper function to draw a list of products to a PDF canvas and return the PDF as bytes.
     """
-    output_buffer = BytesIO()
-    c = canvas.Canvas(output_buffer, pagesize=A4)
+    return _create_pdfs_from_products([products], use_heebo)[0]
+
+def _create_pdfs_from_products(product_lists, use_heebo):
+    """
+    Draws several equally long product lists (e.g. LLM and original names) in a single pass
+    over the sign grid, one canvas per list. Returns one PDF BytesIO per list.
+    """
+    # reportlab builds the whole PDF in memory and writes it with a single write() on save,
+    # so a plain BytesIO never grows incrementally. Compression is pinned on explicitly
+    # rather than relying on the rl_config default.
+    buffers = [BytesIO() for _ in product_lists]
+    canvases = [canvas.Canvas(buf, pagesize=A4, pageCompression=1) for buf in buffers]
     width, height = A4
     x_gap, y_gap, x_start = 0.03 * cm, 1, 0
     y_start = height - SIGN_HEIGHT
     cur_x, cur_y, col_count = x_start, y_start, 0
-    for prod in products:
-        draw_discount_sign(c, cur_x, cur_y, prod) if prod.get('is_sale') else draw_sign(c, cur_x, cur_y, prod, use_heebo)
+    for prods in zip(*product_lists):
+        for c, prod in zip(canvases, prods):
+            draw_discount_sign(c, cur_x, cur_y, prod) if prod.get('is_sale') else draw_sign(c, cur_x, cur_y, prod, use_heebo)
         col_count += 1
         if col_count < 2:
             cur_x += SIGN_WIDTH + x_gap
         else:
             col_count, cur_x, cur_y = 0, x_start, cur_y - (SIGN_HEIGHT + y_gap)
             if cur_y < 0:
-                c.showPage()
+                for c in canvases: c.showPage()
                 cur_x, cur_y = x_start, y_start
-    c.save()
-    output_buffer.seek(0)
-    return output_buffer
+    for c, buf in zip(canvases, buffers):
+        c.save()
+        buf.seek(0)
+    return buffers
     
 # --- Data Handling & Main Functions ---
+# --- Column Normalization ---
+def _clean_barcodes(series):
+    """Barcodes as strings, without the '.0' Excel adds to numeric cells."""
+    return series.astype(str).str.removesuffix('.0')
+
+def _clean_strings(series):
+    """Values as stripped strings, with blank cells as ''."""
+    return series.where(series.notna(), "").astype(str).str.strip()
+
+def _numeric_column(df, col):
+    """
+    Column as floats, with blank cells (or a missing column) as 0.
+    Raises ValueError listing the offending cells if any non-blank value isn't a number.
+    """
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    numbers = pd.to_numeric(df[col], errors='coerce')
+    invalid = numbers.isna() & _nonblank_flags(df, col)
+    if invalid.any():
+        # Excel row numbers: 1-based, plus the header row
+        cells = ", ".join(f"row {index + 2}: {value!r}" for index, value in df.loc[invalid, col].items())
+        raise ValueError(f"Invalid numbers in column '{col}': {cells}")
+    return numbers.fillna(0.0).astype(float)
+
+def _nonblank_flags(df, col):
+    """Boolean Series: True where column `col` has a non-empty value (all False if the column is missing)."""
+    if col not in df.columns:
+        return pd.Series(False, index=df.index)
+    values = df[col]
+    return values.notna() & (values.astype(str).str.strip() != "")
+
+# --- Firestore ---
+FIRESTORE_READ_CHUNK = 500 # Max refs per get_all call
+FIRESTORE_WRITE_BATCH = 400 # Ops per write batch (Firestore limit is 500)
+FIRESTORE_MAX_WORKERS = 20 # Concurrent Firestore RPCs (I/O bound, so threads are fine)
+FIRESTORE_RETRY_ATTEMPTS = 5
+FIRESTORE_TRANSIENT_ERRORS = (gcp_exceptions.ServiceUnavailable, gcp_exceptions.DeadlineExceeded, gcp_exceptions.Aborted)
+
+@functools.lru_cache(maxsize=1)
+def _firestore_client():
+    """Firestore client, created on first use and reused by later calls (one gRPC channel)."""
+    return firestore.Client()
+
+def _firestore_retry(fn, *args):
+    """Calls fn(*args), retrying transient Firestore errors with exponential backoff."""
+    for attempt in range(FIRESTORE_RETRY_ATTEMPTS):
+        try:
+            return fn(*args)
+        except FIRESTORE_TRANSIENT_ERRORS as e:
+            if attempt == FIRESTORE_RETRY_ATTEMPTS - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+            print(f"Firestore call failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+def _fetch_snapshots(db, refs):
+    """Fetches all refs with concurrent get_all calls of up to FIRESTORE_READ_CHUNK refs each."""
+    chunks = [refs[i:i + FIRESTORE_READ_CHUNK] for i in range(0, len(refs), FIRESTORE_READ_CHUNK)]
+    if not chunks:
+        return []
+    # get_all is lazy; list() it inside the retry so the RPC itself is retried
+    get_chunk = lambda chunk: _firestore_retry(lambda: list(db.get_all(chunk)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(FIRESTORE_MAX_WORKERS, len(chunks))) as executor:
+        return list(itertools.chain.from_iterable(executor.map(get_chunk, chunks)))
+
+def _commit_writes(db, collection_ref, writes):
+    """
+    Applies {doc_id: price or None (delete)} in batches of FIRESTORE_WRITE_BATCH, committed
+    concurrently. Every doc id appears once, so commit order doesn't matter. Any failed commit
+    is re-raised after all batches finish; batches that succeeded stay committed, and since
+    sets and deletes are idempotent, re-running the sheet completes the update.
+    """
+    items = list(writes.items())
+    batches = []
+    for i in range(0, len(items), FIRESTORE_WRITE_BATCH):
+        batch = db.batch()
+        for doc_id, price in items[i:i + FIRESTORE_WRITE_BATCH]:
+            doc_ref = collection_ref.document(doc_id)
+            if price is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, {'price': price})
+        batches.append(batch)
+    if not batches:
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(FIRESTORE_MAX_WORKERS, len(batches))) as executor:
+        futures = [executor.submit(_firestore_retry, batch.commit) for batch in batches]
+    for future in futures:
+        future.result() # Re-raise any commit failure
+
 def filter_and_update_products(df):
     """
     Filters the DataFrame to include only products that need new signs.
@@ -466,44 +719,32 @@ def filter_and_update_products(df):
     Updates Firestore with new prices for these products.
     """
     try:
-        db = firestore.Client()
+        db = _firestore_client()
         collection_ref = db.collection('products')
     except Exception as e:
         print(f"Warning: Could not connect to Firestore: {e}. Skipping persistence check.")
         return df
-    barcodes = df['ברקוד'].astype(str).apply(lambda x: x[:-2] if x.endswith('.0') else x).tolist()
+    # Normalize whole columns up front instead of per row
+    barcodes = _clean_barcodes(df['ברקוד']).tolist()
+    prices = _numeric_column(df, 'מכירה').tolist()
+    force_flags = _nonblank_flags(df, 'אלץ הדפסה').tolist()
+    delete_flags = _nonblank_flags(df, 'מחק').tolist()
     refs = [collection_ref.document(b) for b in barcodes]
-    snapshots, existing_prices = [], {}
-    for i in range(0, len(refs), 500):
-        snapshots.extend(db.get_all(refs[i:i+500]))
-    for snap in snapshots:
+    existing_prices = {}
+    for snap in _fetch_snapshots(db, refs):
         if snap.exists: existing_prices[snap.id] = snap.get('price')
-    batch, batch_count, indices_to_keep = db.batch(), 0, []
-    has_delete_col = 'מחק' in df.columns
+    indices_to_keep = []
+    # Pending write per document id: None = delete, otherwise the new price. A later row for
+    # the same barcode replaces the earlier write, as it would when applied in sheet order, so
+    # each document is written at most once and the batches can commit in any order.
+    writes = {}
 
-    for index, row in df.iterrows():
-        barcode = str(row['ברקוד']); barcode = barcode[:-2] if barcode.endswith('.0') else barcode
-        
-        # Check for Delete flag
-        to_delete = False
-        if has_delete_col:
-            val = row['מחק']
-            if pd.notna(val) and str(val).strip() != "":
-                to_delete = True
-
-        try: price = float(row['מכירה'])
-        except: price = 0.0
-        
-        force_print = 'אלץ הדפסה' in df.columns and pd.notna(row['אלץ הדפסה']) and str(row['אלץ הדפסה']).strip() != ""
-        
+    for index, barcode, price, force_print, to_delete in zip(df.index, barcodes, prices, force_flags, delete_flags):
         if to_delete:
             # Always print, and Delete from Firestore
             indices_to_keep.append(index)
-            # Only delete if it exists to save writes/avoid errors (though delete on non-existing is usually fine in Firestore, 
-            # checking existence might be safer or just blind delete)
             # Standard Firestore delete is idempotent/safe on non-existent docs.
-            batch.delete(collection_ref.document(barcode))
-            batch_count += 1
+            writes[barcode] = None
             print(f"Product {barcode} marked for deletion.")
             
         else:
@@ -512,11 +753,9 @@ def filter_and_update_products(df):
             if should_print:
                 indices_to_keep.append(index)
                 if not force_print:
-                    batch.set(collection_ref.document(barcode), {'price': price}); batch_count += 1
-        
-        if batch_count >= 400:
-            batch.commit(); batch = db.batch(); batch_count = 0
-    if batch_count > 0: batch.commit()
+                    writes[barcode] = price
+
+    _commit_writes(db, collection_ref, writes)
     print(f"Filtered {len(df)} products down to {len(indices_to_keep)} for printing.")
     return df.loc[indices_to_keep]
 
@@ -529,15 +768,47 @@ def validate_dataframe(df):
     if missing := [col for col in required if col not in df.columns]:
         raise ValueError(f"Missing required columns: {', '.join(missing)}. Please check your template.")
 
-def generate_llm_and_original_pdfs(excel_file_obj):
+def _dataframe_to_xlsx(df):
+    """
+    Writes df (header row + values, no index) to an .xlsx BytesIO with openpyxl's write-only
+    mode, which streams rows instead of building the full cell graph like to_excel does.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Alignment, Border, Font, Side
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    # Same header look as pandas' to_excel: bold, centered, thin border
+    thin = Side(style='thin')
+    header = []
+    for col in df.columns:
+        cell = WriteOnlyCell(ws, value=str(col))
+        cell.font, cell.alignment = Font(bold=True), Alignment(horizontal='center', vertical='top')
+        cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        header.append(cell)
+    ws.append(header)
+    # Blank cells (NaN/NaT) are written as empty, not as 'nan'
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+        ws.append(row)
+    output_buffer = BytesIO()
+    wb.save(output_buffer)
+    output_buffer.seek(0)
+    return output_buffer
+
+def generate_llm_and_original_pdfs(excel_file_obj, df=None):
     """
     Generates two PDFs from an Excel file: one with LLM-cleaned names and one with original names.
     Also generates an Excel file with the final names used in the LLM version.
+    Callers that already have the sheet as a DataFrame can pass it as `df` to skip the xlsx parse.
     Returns a tuple of BytesIO objects: (llm_pdf_bytes, original_pdf_bytes, llm_excel_bytes).
     """
     use_heebo = register_fonts()
     try:
-        df = pd.read_excel(excel_file_obj)
+        if df is None:
+            df = pd.read_excel(excel_file_obj, engine=EXCEL_READ_ENGINE)
+        else:
+            df = df.copy(deep=False) # Don't rename the caller's columns
         df.columns = df.columns.str.strip()
         validate_dataframe(df)
         df_to_print = filter_and_update_products(df)
@@ -548,75 +819,51 @@ def generate_llm_and_original_pdfs(excel_file_obj):
         print(f"Error reading/validating Excel: {e}")
         raise e
     
-    clean_str = lambda val: str(val).strip() if pd.notna(val) else ""
-    clean_barcode = lambda val: clean_str(val)[:-2] if clean_str(val).endswith('.0') else clean_str(val)
-    clean_price = lambda val: float(val) if pd.notna(val) else 0
-
-    # Prepare data for LLM and PDFs
-    products_for_pdf = []
-    names_to_clean = []
-    original_names = []
-    
-    # Check if 'Force Original Name' column exists
-    force_col = 'אלץ שם מקורי'
-    has_force_col = force_col in df_to_print.columns
-
-    for index, row in df_to_print.iterrows():
-        original_name = clean_str(row.get('שם פריט'))
-        forced = False
-        if has_force_col:
-            val = row[force_col]
-            if pd.notna(val) and str(val).strip() != "":
-                forced = True
-        
-        prod_data = {
-            "price": clean_price(row.get('מכירה', 0)), 
-            "name": original_name,
-            "barcode": clean_barcode(row.get('ברקוד')), 
-            "is_sale": pd.notna(row.get('מבצע')) and clean_str(row.get('מבצע')) != '',
-            "prev_price": clean_price(row.get('מחיר קודם', 0)),
+    # Prepare data for LLM and PDFs. Each column is normalized once, then zipped row by row.
+    name_col = _clean_strings(df_to_print['שם פריט'])
+    names = name_col.tolist()
+    barcodes = _clean_strings(df_to_print['ברקוד']).str.removesuffix('.0').tolist()
+    prices = _numeric_column(df_to_print, 'מכירה').tolist()
+    prev_prices = _numeric_column(df_to_print, 'מחיר קודם').tolist()
+    sale_flags = _nonblank_flags(df_to_print, 'מבצע').tolist()
+    # 'Force Original Name' column (optional)
+    forced_col = _nonblank_flags(df_to_print, 'אלץ שם מקורי')
+    forced_flags = forced_col.tolist()
+
+    products_for_pdf = [
+        {
+            "price": price,
+            "name": name,
+            "barcode": barcode,
+            "is_sale": is_sale,
+            "prev_price": prev_price,
             "force_original": forced,
             "original_row_index": index # Keep track of original index to update DataFrame later
         }
-        products_for_pdf.append(prod_data)
-        original_names.append(original_name)
-        
-        if not forced:
-            names_to_clean.append(original_name)
+        for index, name, price, barcode, is_sale, prev_price, forced
+        in zip(df_to_print.index, names, prices, barcodes, sale_flags, prev_prices, forced_flags)
+    ]
+    names_to_clean = [name for name, forced in zip(names, forced_flags) if not forced]
 
-    # Batch clean words using LLM
+    # Batch clean words using LLM (each distinct name only once)
+    names_to_clean = list(dict.fromkeys(names_to_clean))
     cleaned_names_map = {}
     if names_to_clean:
         print(f"Sending {len(names_to_clean)} names to the LLM for cleaning...")
         cleaned_names_map = clean_product_names_batch(names_to_clean)
         print("Received cleaned names from LLM.")
 
-    # Apply cleaned names where appropriate
-    products_llm = []
-    products_original = []
-    
-    # Store final names map for Excel update
-    final_names_map = {} # index -> final_name
-
-    for prod in products_for_pdf:
-        # Create LLM version
-        p_llm = prod.copy()
-        if prod['force_original']:
-             p_llm['name'] = prod['name'] # Keep original
-        else:
-             p_llm['name'] = cleaned_names_map.get(prod['name'], prod['name'])
-        
-        products_llm.append(p_llm)
-        final_names_map[prod['original_row_index']] = p_llm['name']
+    # Final names for the LLM version, for the whole column at once: the cleaned name,
+    # or the original where it is forced (or the LLM returned nothing for it)
+    llm_names = name_col.map(cleaned_names_map).fillna(name_col).where(~forced_col, name_col)
 
-        # Create Original version
-        p_orig = prod.copy() # Name is already original
-        products_original.append(p_orig)
+    # Only 'name' differs between the two versions, and the PDF writer only reads the dicts,
+    # so the original version reuses products_for_pdf.
+    products_llm = [{**prod, 'name': name} for prod, name in zip(products_for_pdf, llm_names.tolist())]
+    products_original = products_for_pdf
 
-    print("Generating PDF with LLM-cleaned names...")
-    llm_pdf_bytes = _create_pdf_from_products(products_llm, use_heebo)
-    print("Generating PDF with original names...")
-    original_pdf_bytes = _create_pdf_from_products(products_original, use_heebo)
+    print("Generating PDFs with LLM-cleaned and original names...")
+    llm_pdf_bytes, original_pdf_bytes = _create_pdfs_from_products([products_llm, products_original], use_heebo)
     
     # --- Generate Excel with Cleaned Names ---
     print("Generating Excel with cleaned names...")
@@ -624,14 +871,10 @@ def generate_llm_and_original_pdfs(excel_file_obj):
     # Create a copy of the dataframe to avoid modifying the original if passed by reference (though read_excel creates new)
     df_output = df_to_print.copy()
     
-    # Add 'Cleaned Name' column
-    # We map the final names back using the original index
-    df_output['Cleaned Name'] = df_output.index.map(final_names_map)
+    # Add 'Cleaned Name' column (aligned on the original index)
+    df_output['Cleaned Name'] = llm_names
     
-    output_excel_buffer = BytesIO()
-    with pd.ExcelWriter(output_excel_buffer, engine='openpyxl') as writer:
-        df_output.to_excel(writer, index=False)
-    output_excel_buffer.seek(0)
+    output_excel_buffer = _dataframe_to_xlsx(df_output)
     
     print("PDF and Excel generation complete.")
     
@@ -0,0 +1,82 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import threading
+import tempfile
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import signage_lib
+
+def fake_gemini_client(requests_seen):
+    """A stand-in genai client that upper-cases every name in the prompt's input list."""
+    lock = threading.Lock()
+
+    def generate_content(model, contents, config):
+        input_json = contents.split("### Input List (Clean these)")[1].split("### Output JSON")[0]
+        names = json.loads(input_json)
+        with lock:
+            requests_seen.append(names)
+        response = MagicMock()
+        response.text = json.dumps({name: name.upper() for name in names})
+        return response
+
+    client = MagicMock()
+    client.models.generate_content.side_effect = generate_content
+    return client
+
+class TestCleanProductNames(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        cache_path = os.path.join(self.tmp_dir.name, 'names.sqlite3')
+        self.cache_patch = patch.object(signage_lib, 'NAME_CACHE_PATH', cache_path)
+        self.cache_patch.start()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def clean(self, names, requests_seen):
+        with patch.object(signage_lib, '_gemini', return_value=(fake_gemini_client(requests_seen), None, None)):
+            return signage_lib.clean_product_names_batch(names)
+
+    def test_large_batches_are_sharded(self):
+        names = [f"name {i}" for i in range(60)]
+        requests_seen = []
+        result = self.clean(names, requests_seen)
+        self.assertEqual(result, {name: name.upper() for name in names})
+        self.assertEqual(sorted(len(r) for r in requests_seen), [10, 25, 25])
+
+    def test_small_batch_is_one_request(self):
+        requests_seen = []
+        result = self.clean(['a', 'b'], requests_seen)
+        self.assertEqual(result, {'a': 'A', 'b': 'B'})
+        self.assertEqual(requests_seen, [['a', 'b']])
+
+    def test_cached_names_are_not_resent(self):
+        requests_seen = []
+        self.clean(['a', 'b'], requests_seen)
+        result = self.clean(['b', 'c'], requests_seen)
+        self.assertEqual(result, {'b': 'B', 'c': 'C'})
+        self.assertEqual(requests_seen, [['a', 'b'], ['c']])
+
+    def test_model_change_invalidates_cache(self):
+        requests_seen = []
+        self.clean(['a', 'b'], requests_seen)
+        with patch.object(signage_lib, 'model_name', 'another-model'):
+            self.clean(['a', 'b'], requests_seen)
+        self.assertEqual(requests_seen, [['a', 'b'], ['a', 'b']])
+
+class TestParseLlmResponse(unittest.TestCase):
+
+    def test_strips_code_fence(self):
+        text = '```json\n{"a": "b"}\n```'
+        self.assertEqual(signage_lib._parse_and_validate_llm_response(text, "test"), {'a': 'b'})
+
+    def test_recovers_list_of_pairs(self):
+        text = '[{"Original": "a", "CLEANED": "b"}, {"c": "d"}]'
+        self.assertEqual(signage_lib._parse_and_validate_llm_response(text, "test"), {'a': 'b', 'c': 'd'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+from unittest.mock import patch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import env_loader
+
+class TestEnvLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmp_dir.cleanup()
+
+    def test_reads_env_json(self):
+        with open('env.json', 'w') as f:
+            json.dump({'GCP_PROJECT_ID': 'p', 'GCP_SECRET_VERSIONS_TO_KEEP': 3}, f)
+        self.assertEqual(env_loader.read_env_file(), {'GCP_PROJECT_ID': 'p', 'GCP_SECRET_VERSIONS_TO_KEEP': 3})
+
+    def test_missing_file(self):
+        self.assertIsNone(env_loader.read_env_file())
+        self.assertIsNone(env_loader.read_env_file('env.json'))
+
+    def test_rereads_after_change(self):
+        with open('env.json', 'w') as f:
+            json.dump({'GEMINI_API_KEY': 'a'}, f)
+        self.assertEqual(env_loader.read_env_file()['GEMINI_API_KEY'], 'a')
+        with open('env.json', 'w') as f:
+            json.dump({'GEMINI_API_KEY': 'bb'}, f)
+        self.assertEqual(env_loader.read_env_file()['GEMINI_API_KEY'], 'bb')
+
+    def test_yaml_without_pyyaml_explains(self):
+        with open('env.yaml', 'w') as f:
+            f.write('GCP_PROJECT_ID: p\n')
+        with patch.dict(sys.modules, {'yaml': None}):
+            with self.assertRaisesRegex(ImportError, 'convert it to env.json'):
+                env_loader.read_env_file()
+
+if __name__ == '__main__':
+    unittest.main()
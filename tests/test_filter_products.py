@@ -0,0 +1,154 @@
+import unittest
+from unittest.mock import patch
+import threading
+import pandas as pd
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import signage_lib
+from google.api_core import exceptions as gcp_exceptions
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data or {}
+
+    def get(self, field):
+        return self._data[field]
+
+class FakeRef:
+    def __init__(self, doc_id):
+        self.id = doc_id
+
+class FakeCollection:
+    def document(self, doc_id):
+        return FakeRef(doc_id)
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.ops = []
+
+    def set(self, ref, data):
+        self.ops.append(('set', ref.id, data))
+
+    def delete(self, ref):
+        self.ops.append(('delete', ref.id))
+
+    def commit(self):
+        if self.db.fail_commits:
+            raise gcp_exceptions.PermissionDenied("no access")
+        with self.db.lock:
+            self.db.committed.extend(self.ops)
+
+class FakeFirestore:
+    """Minimal in-memory stand-in for firestore.Client."""
+
+    def __init__(self, prices, fail_first_get_all=False):
+        self.prices = prices
+        self.committed = []
+        self.get_all_calls = 0
+        self.fail_first_get_all = fail_first_get_all
+        self.fail_commits = False
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection()
+
+    def get_all(self, refs):
+        with self.lock:
+            self.get_all_calls += 1
+            fail = self.fail_first_get_all and self.get_all_calls == 1
+        if fail:
+            raise gcp_exceptions.ServiceUnavailable("try again")
+        for ref in refs:
+            price = self.prices.get(ref.id)
+            yield FakeSnapshot(ref.id, None if price is None else {'price': price})
+
+    def batch(self):
+        return FakeBatch(self)
+
+class TestFilterAndUpdateProducts(unittest.TestCase):
+
+    def setUp(self):
+        # The client is cached per process; make each test build its own fake
+        signage_lib._firestore_client.cache_clear()
+        self.addCleanup(signage_lib._firestore_client.cache_clear)
+
+    def run_filter(self, df, db):
+        with patch('signage_lib.firestore.Client', return_value=db), patch('signage_lib.time.sleep'):
+            return signage_lib.filter_and_update_products(df)
+
+    def test_keeps_new_changed_forced_and_deleted(self):
+        df = pd.DataFrame({
+            'ברקוד': [1.0, '2', '3', '4', '5'],
+            'מכירה': [10, 20, 30, 40, 50],
+            'אלץ הדפסה': ['', '', '', 'yes', ''],
+            'מחק': ['', '', '', '', 'x'],
+        })
+        db = FakeFirestore({'2': 20.0, '3': 99.0, '4': 40.0, '5': 50.0})
+        result = self.run_filter(df, db)
+        # 1 is new, 2 unchanged, 3 changed price, 4 forced, 5 deleted
+        self.assertEqual(list(result.index), [0, 2, 3, 4])
+        self.assertCountEqual(db.committed, [
+            ('set', '1', {'price': 10.0}),
+            ('set', '3', {'price': 30.0}),
+            ('delete', '5'),
+        ])
+
+    def test_reads_in_chunks_and_retries_transient_errors(self):
+        count = 1201
+        df = pd.DataFrame({'ברקוד': [str(i) for i in range(count)], 'מכירה': [1] * count})
+        db = FakeFirestore({str(i): 1.0 for i in range(count)}, fail_first_get_all=True)
+        result = self.run_filter(df, db)
+        self.assertTrue(result.empty)
+        # 3 chunks of <=500 refs, plus one retried call
+        self.assertEqual(db.get_all_calls, 4)
+
+    def test_commits_every_write_in_batches(self):
+        count = 950
+        df = pd.DataFrame({'ברקוד': [str(i) for i in range(count)], 'מכירה': [5] * count})
+        db = FakeFirestore({})
+        result = self.run_filter(df, db)
+        self.assertEqual(len(result), count)
+        self.assertCountEqual(db.committed, [('set', str(i), {'price': 5.0}) for i in range(count)])
+
+    def test_duplicate_barcode_writes_once_with_last_row(self):
+        df = pd.DataFrame({
+            'ברקוד': ['1', '2', '1', '2'],
+            'מכירה': [10, 20, 11, 20],
+            'מחק': ['', '', '', 'x'],
+        })
+        db = FakeFirestore({})
+        self.run_filter(df, db)
+        self.assertCountEqual(db.committed, [('set', '1', {'price': 11.0}), ('delete', '2')])
+
+    def test_commit_failure_is_raised(self):
+        df = pd.DataFrame({'ברקוד': [str(i) for i in range(900)], 'מכירה': [1] * 900})
+        db = FakeFirestore({})
+        db.fail_commits = True
+        with self.assertRaises(gcp_exceptions.PermissionDenied):
+            self.run_filter(df, db)
+
+    def test_malformed_price_is_rejected(self):
+        df = pd.DataFrame({'ברקוד': ['1', '2', '3'], 'מכירה': [10, '12,90', 'abc']})
+        db = FakeFirestore({})
+        with self.assertRaises(ValueError) as ctx:
+            self.run_filter(df, db)
+        self.assertIn("row 3: '12,90'", str(ctx.exception))
+        self.assertIn("row 4: 'abc'", str(ctx.exception))
+        # Nothing is read or written for a sheet with bad prices
+        self.assertEqual(db.get_all_calls, 0)
+        self.assertEqual(db.committed, [])
+
+    def test_reuses_client(self):
+        df = pd.DataFrame({'ברקוד': ['1'], 'מכירה': [1]})
+        db = FakeFirestore({'1': 1.0})
+        with patch('signage_lib.firestore.Client', return_value=db) as client_cls:
+            signage_lib.filter_and_update_products(df)
+            signage_lib.filter_and_update_products(df)
+        client_cls.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import find_excel
+
+class TestFindExcel(unittest.TestCase):
+
+    def test_finds_nested_attachment_in_order(self):
+        parts = [
+            {'filename': '', 'parts': [
+                {'filename': 'notes.txt', 'body': {'attachmentId': 'T1'}},
+                {'filename': 'first.xlsx', 'body': {'attachmentId': 'A1'}},
+            ]},
+            {'filename': 'second.xlsx', 'body': {'attachmentId': 'A2'}},
+        ]
+        self.assertEqual(find_excel(parts), ('A1', 'first.xlsx'))
+
+    def test_suffix_is_case_insensitive(self):
+        parts = [{'filename': 'PRICES.XLSX', 'body': {'attachmentId': 'A1'}}]
+        self.assertEqual(find_excel(parts), ('A1', 'PRICES.XLSX'))
+
+    def test_no_excel_attachment(self):
+        parts = [{'filename': 'signs.pdf', 'body': {'attachmentId': 'P1'}}]
+        self.assertEqual(find_excel(parts), (None, None))
+        self.assertEqual(find_excel([]), (None, None))
+
+if __name__ == '__main__':
+    unittest.main()
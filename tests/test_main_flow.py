@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 import unittest.mock
 from io import BytesIO
 
@@ -17,7 +18,10 @@ def test_email_logic():
     # We need to mock firestore so it fails to connect. 
     # This triggers the 'except' block in 'filter_and_update_products', 
     # which returns the full dataframe (skipping the "already printed" check).
-    with unittest.mock.patch('signage_lib.firestore.Client') as mock_firestore:
+    # Keep the name cache out of the shared temp dir
+    with unittest.mock.patch('signage_lib.firestore.Client') as mock_firestore, \
+         tempfile.TemporaryDirectory() as cache_dir, \
+         unittest.mock.patch('signage_lib.NAME_CACHE_PATH', os.path.join(cache_dir, 'names.sqlite3')):
         mock_firestore.side_effect = Exception("Mocked Firestore Connection Failure")
         
         try: